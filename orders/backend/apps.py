@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class BackendConfig(AppConfig):
     name = 'backend'
+
+    def ready(self):
+        """
+        импортируем сигналы (нужны и вне views, например в воркере импорта)
+        """
+        import backend.signals  # noqa: F401
@@ -0,0 +1,149 @@
+import heapq
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection
+
+from backend.models import CatalogItem, Shop
+
+"""Модуль автодополнения названий товаров"""
+# Индекс хранится в памяти процесса отдельно для каждого магазина: отсортированный массив нормализованных
+# слов названий продуктов и моделей, поиск по префиксу - двоичный (bisect), без запросов к БД.
+# Количество предложений с фразой по всем магазинам хранится в общем Counter.
+# Раз в AUTOCOMPLETE_CHECK_INTERVAL секунд в фоновом потоке сверяются версии каталогов магазинов
+# (Shop.catalog_version, меняется при импорте прайса и изменении магазина), перестраиваются индексы только
+# изменившихся магазинов, и новый индекс подменяется одним присваиванием. Запрос автодополнения индекс
+# не перестраивает (кроме самого первого запроса в процессе, когда индекса ещё нет).
+
+AUTOCOMPLETE_CHECK_INTERVAL = getattr(settings, 'AUTOCOMPLETE_CHECK_INTERVAL', 5)
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 50
+# для коротких префиксов совпадений слишком много, лучшие подсказки для них считаются при сборке индекса
+# магазина; в ответ попадают лучшие по всем магазинам из лучших подсказок каждого магазина
+SHORT_PREFIX = 2
+
+
+def normalize(text):
+    """Слова строки в нижнем регистре, ё заменяется на е"""
+    return re.findall(r'\w+', text.lower().replace('ё', 'е'))
+
+
+def _best(found, key, limit):
+    return heapq.nsmallest(limit, found, key=key)
+
+
+class ShopIndex:
+    """Индекс автодополнения одного магазина"""
+
+    def __init__(self, phrases):
+        # phrases - Counter(фраза -> количество предложений магазина с фразой)
+        self.phrases = Counter(phrases)
+        self.texts = sorted(self.phrases)
+        self.words = [tuple(normalize(phrase)) for phrase in self.texts]
+        pairs = sorted({(word, number) for number, words in enumerate(self.words) for word in words})
+        self.tokens, self.refs = [token for token, _ in pairs], [number for _, number in pairs]
+        counts = [self.phrases[phrase] for phrase in self.texts]
+        self.top = {}
+        for prefix in {token[:length] for token in self.tokens for length in range(1, SHORT_PREFIX + 1)}:
+            start, end = self._range(prefix)
+            self.top[prefix] = [self.texts[number] for number in _best(
+                set(self.refs[start:end]), lambda number: (-counts[number], self.texts[number]),
+                AUTOCOMPLETE_MAX_LIMIT)]
+
+    def _range(self, prefix):
+        start = bisect_left(self.tokens, prefix)
+        return start, bisect_left(self.tokens, prefix + '\uffff', start)
+
+    def matches(self, words):
+        """Фразы магазина, каждое слово запроса в которых является началом какого-либо слова фразы"""
+        if len(words) == 1 and len(words[0]) <= SHORT_PREFIX:
+            return self.top.get(words[0], [])
+        # берём слово запроса с наименьшим числом совпадений, остальные слова проверяем у найденных фраз
+        ranges = {word: self._range(word) for word in words}
+        first = min(ranges, key=lambda word: ranges[word][1] - ranges[word][0])
+        found = set(self.refs[slice(*ranges[first])])
+        for word in words:
+            if word != first:
+                found = {number for number in found
+                         if any(phrase_word.startswith(word) for phrase_word in self.words[number])}
+        return [self.texts[number] for number in found]
+
+
+class AutocompleteIndex:
+    """Индекс автодополнения по активным магазинам"""
+
+    def __init__(self, check_interval=AUTOCOMPLETE_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.checked_at = 0
+        # (id магазина -> (версия каталога, ShopIndex), Counter(фраза -> количество предложений во всех магазинах))
+        self.index = None
+        self.lock = threading.Lock()  # одна перестройка индекса за раз
+        self.schedule_lock = threading.Lock()
+        self.refreshing = False
+
+    def refresh(self):
+        """Перестраивает индексы магазинов, версия каталога которых изменилась, и подменяет индекс"""
+        with self.lock:
+            self.checked_at = time.monotonic()
+            shops, totals = self.index or ({}, Counter())
+            versions = dict(Shop.objects.filter(state=True).values_list('id', 'catalog_version'))
+            changed = [shop_id for shop_id, version in versions.items() if shops.get(shop_id, (None,))[0] != version]
+            removed = shops.keys() - versions.keys()
+            if self.index is not None and not changed and not removed:
+                return
+            shops, totals = dict(shops), totals.copy()
+            for shop_id in removed:
+                totals.subtract(shops.pop(shop_id)[1].phrases)
+            for shop_id in changed:
+                phrases = Counter()
+                for name, model in CatalogItem.objects.filter(shop_id=shop_id).values_list('product_name', 'model'):
+                    phrases[name] += 1
+                    if model:
+                        phrases[model] += 1
+                if shop_id in shops:
+                    totals.subtract(shops[shop_id][1].phrases)
+                totals.update(phrases)
+                shops[shop_id] = (versions[shop_id], ShopIndex(phrases))
+            # индекс заменяется одним присваиванием, параллельные lookup() видят либо старый, либо новый
+            self.index = (shops, +totals)
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            self.refreshing = False
+            # у фонового потока своё соединение с БД, закрываем его
+            connection.close()
+
+    def schedule_refresh(self):
+        """Запускает проверку версий в фоновом потоке, если с прошлой проверки прошло check_interval секунд"""
+        if self.refreshing or time.monotonic() - self.checked_at < self.check_interval:
+            return
+        with self.schedule_lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self._refresh_in_background, daemon=True).start()
+
+    def lookup(self, text, limit=AUTOCOMPLETE_LIMIT):
+        """Фразы, каждое слово запроса в которых является началом какого-либо слова фразы"""
+        if self.index is None:
+            self.refresh()
+        else:
+            self.schedule_refresh()
+        words = normalize(text)
+        if not words:
+            return []
+        shops, totals = self.index
+        found = set()
+        for _, shop_index in shops.values():
+            found.update(shop_index.matches(words))
+        best = _best(found, lambda phrase: (-totals[phrase], phrase), limit)
+        return [{'value': phrase, 'count': totals[phrase]} for phrase in best]
+
+
+autocomplete_index = AutocompleteIndex()
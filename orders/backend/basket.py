@@ -0,0 +1,190 @@
+from django.db import connection, transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from backend.catalog import record_changes
+from backend.fast_serializers import chunks
+from backend.models import CatalogItem, Order, OrderItem, ProductInfo
+
+"""Модуль изменения позиций корзины, итогов и оформления заказов"""
+# Позиции корзины записываются одним запросом INSERT ... ON CONFLICT DO UPDATE на пачку (PostgreSQL,
+# SQLite 3.24+): новые товары добавляются, количество уже лежащих в корзине увеличивается.
+# Уникальность товара в заказе обеспечивает ограничение unique_order_item модели OrderItem.
+# Итоги заказа (Order.items_count, items_cost, items_cost_rrc) меняются на разницу в той же транзакции,
+# что и позиции, поэтому при чтении заказов сумма по позициям не считается.
+# При изменении цен и удалении товаров импортом итоги затронутых заказов пересчитываются целиком.
+# При оформлении заказа товары резервируются: остатки (ProductInfo.quantity) уменьшаются одним условным
+# запросом UPDATE на все позиции, при нехватке любой позиции заказ не оформляется. Блокируются только строки
+# товаров заказа (в порядке id, чтобы параллельные заказы не взаимоблокировались), отмена возвращает остатки.
+# Новые остатки переносятся в строки каталога этих же товаров и в журнал изменений. Общих для магазина
+# или всего каталога строк и блокировок транзакция не трогает: заказы разных товаров не ждут друг друга.
+# Ключ кэша каталога меняется после фиксации, когда записи журнала получают seq (см. backend/cache.py).
+
+# позиций в одном запросе (по три параметра на позицию)
+UPSERT_BATCH_SIZE = 300
+
+# статусы, в которых покупатель может отменить заказ
+CANCELABLE_STATUSES = ('new', 'confirmed')
+
+
+class OutOfStock(Exception):
+    """Недостаточно товара на складе; product_info_ids - товары, которых не хватает"""
+
+    def __init__(self, product_info_ids):
+        super().__init__(product_info_ids)
+        self.product_info_ids = product_info_ids
+
+
+def _lock_order(order_id):
+    """Блокировка заказа до конца транзакции: изменения одного заказа идут по очереди"""
+    Order.objects.select_for_update().only('id').get(id=order_id)
+
+
+def _add_totals(order_id, count=0, cost=0, cost_rrc=0):
+    if count or cost or cost_rrc:
+        Order.objects.filter(id=order_id).update(items_count=F('items_count') + count,
+                                                 items_cost=F('items_cost') + cost,
+                                                 items_cost_rrc=F('items_cost_rrc') + cost_rrc)
+
+
+def add_basket_items(order_id, quantities, prices):
+    """
+    Добавляет товары в корзину: quantities - {id товара: количество}, prices - {id товара: (price, price_rrc)}.
+    Возвращает (количество новых позиций, количество позиций с увеличенным количеством)
+    """
+    if not quantities:
+        return 0, 0
+    quote = connection.ops.quote_name
+    table = quote(OrderItem._meta.db_table)
+    order, product_info, quantity = (quote(OrderItem._meta.get_field(name).column)
+                                     for name in ('order', 'product_info', 'quantity'))
+    with transaction.atomic():
+        _lock_order(order_id)
+        existing = set(OrderItem.objects.filter(order_id=order_id, product_info_id__in=quantities)
+                       .values_list('product_info_id', flat=True))
+        with connection.cursor() as cursor:
+            for chunk in chunks(sorted(quantities.items()), UPSERT_BATCH_SIZE):
+                cursor.execute(
+                    f'INSERT INTO {table} ({order}, {product_info}, {quantity}) '
+                    f'VALUES {", ".join(["(%s, %s, %s)"] * len(chunk))} '
+                    f'ON CONFLICT ({order}, {product_info}) '
+                    f'DO UPDATE SET {quantity} = {table}.{quantity} + excluded.{quantity}',
+                    [value for product_info_id, count in chunk for value in (order_id, product_info_id, count)])
+        _add_totals(order_id, count=len(quantities) - len(existing),
+                    cost=sum(count * prices[product_info_id][0] for product_info_id, count in quantities.items()),
+                    cost_rrc=sum(count * prices[product_info_id][1]
+                                 for product_info_id, count in quantities.items()))
+    return len(quantities) - len(existing), len(existing)
+
+
+def _basket_rows(order_id, item_ids):
+    return list(OrderItem.objects.filter(order_id=order_id, id__in=item_ids).values(
+        'id', 'quantity', 'product_info__price', 'product_info__price_rrc'))
+
+
+def update_basket_items(order_id, quantities):
+    """Меняет количество в позициях корзины: quantities - {id позиции: количество}. Возвращает число позиций"""
+    with transaction.atomic():
+        _lock_order(order_id)
+        rows = _basket_rows(order_id, quantities)
+        OrderItem.objects.bulk_update([OrderItem(id=row['id'], quantity=quantities[row['id']]) for row in rows],
+                                      ['quantity'])
+        _add_totals(order_id,
+                    cost=sum((quantities[row['id']] - row['quantity']) * row['product_info__price'] for row in rows),
+                    cost_rrc=sum((quantities[row['id']] - row['quantity']) * row['product_info__price_rrc']
+                                 for row in rows))
+    return len(rows)
+
+
+def remove_basket_items(order_id, item_ids):
+    """Удаляет позиции из корзины. Возвращает число удалённых позиций"""
+    with transaction.atomic():
+        _lock_order(order_id)
+        rows = _basket_rows(order_id, item_ids)
+        deleted = OrderItem.objects.filter(id__in=[row['id'] for row in rows]).delete()[0]
+        _add_totals(order_id, count=-len(rows),
+                    cost=-sum(row['quantity'] * row['product_info__price'] for row in rows),
+                    cost_rrc=-sum(row['quantity'] * row['product_info__price_rrc'] for row in rows))
+    return deleted
+
+
+def recalculate_order_totals(order_ids):
+    """Пересчёт итогов заказов по их позициям одним запросом; order_ids - список или подзапрос"""
+    items = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+    return Order.objects.filter(id__in=order_ids).update(
+        items_count=Coalesce(Subquery(items.annotate(total=Count('id')).values('total')), 0),
+        items_cost=Coalesce(Subquery(items.annotate(
+            total=Sum(F('quantity') * F('product_info__price'))).values('total')), 0),
+        items_cost_rrc=Coalesce(Subquery(items.annotate(
+            total=Sum(F('quantity') * F('product_info__price_rrc'))).values('total')), 0))
+
+
+def _lock_stock(order_id):
+    """Позиции заказа {id товара: количество} и заблокированные строки товаров {id товара: (остаток, магазин)}"""
+    lines = dict(OrderItem.objects.filter(order_id=order_id).values_list('product_info_id', 'quantity'))
+    stock = {product_info_id: (quantity, shop_id) for product_info_id, quantity, shop_id in
+             ProductInfo.objects.select_for_update().filter(id__in=lines).order_by('id')
+             .values_list('id', 'quantity', 'shop_id')}
+    return lines, stock
+
+
+def _move_stock(order_id, lines, reserve):
+    """Списывает (reserve=True) или возвращает остатки товаров заказа одним запросом на все позиции"""
+    requested = Subquery(OrderItem.objects.filter(order_id=order_id, product_info_id=OuterRef('pk'))
+                         .values('quantity'))
+    products = ProductInfo.objects.filter(id__in=lines)
+    if reserve:
+        # условие проверяется в самом UPDATE: остаток не уйдёт в минус при любом порядке транзакций
+        moved = products.filter(quantity__gte=requested).update(quantity=F('quantity') - requested)
+        if moved != len(lines):
+            raise OutOfStock(sorted(lines))
+    else:
+        products.update(quantity=F('quantity') + requested)
+
+
+def _sync_stock(stock):
+    """
+    Новые остатки - в модель чтения каталога и журнал изменений (без блокировок сверх строк товаров заказа).
+    После фиксации записи журнала публикуются, и кэш каталога и ETag перестают отдавать старые остатки
+    """
+    CatalogItem.objects.filter(pk__in=stock).update(
+        quantity=Subquery(ProductInfo.objects.filter(id=OuterRef('pk')).values('quantity')))
+    shops = {}
+    for product_info_id, (_, shop_id) in stock.items():
+        shops.setdefault(shop_id, []).append(product_info_id)
+    for shop_id, product_info_ids in shops.items():
+        record_changes(shop_id, 'updated', product_info_ids)
+
+
+def checkout_order(user_id, order_id, contact_id):
+    """
+    Оформление корзины order_id с резервированием товаров.
+    Возвращает False, если такой корзины у пользователя нет; при нехватке товаров - исключение OutOfStock
+    """
+    with transaction.atomic():
+        order = Order.objects.select_for_update().filter(user_id=user_id, id=order_id, status='basket').first()
+        if order is None:
+            return False
+        lines, stock = _lock_stock(order.id)
+        short = sorted(product_info_id for product_info_id, quantity in lines.items()
+                       if stock[product_info_id][0] < quantity)
+        if short:
+            raise OutOfStock(short)
+        _move_stock(order.id, lines, reserve=True)
+        Order.objects.filter(id=order.id).update(status='new', contact_id=contact_id)
+        _sync_stock(stock)
+    return True
+
+
+def cancel_order(user_id, order_id):
+    """Отмена заказа с возвратом зарезервированных товаров. Возвращает False, если отменить заказ нельзя"""
+    with transaction.atomic():
+        order = Order.objects.select_for_update().filter(user_id=user_id, id=order_id,
+                                                         status__in=CANCELABLE_STATUSES).first()
+        if order is None:
+            return False
+        lines, stock = _lock_stock(order.id)
+        _move_stock(order.id, lines, reserve=False)
+        Order.objects.filter(id=order.id).update(status='canceled')
+        _sync_stock(stock)
+    return True
@@ -0,0 +1,147 @@
+import functools
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.db import connection
+from django.db.models import Count, F, Max, Sum
+from rest_framework.response import Response
+
+from backend.models import CatalogChange, Category, Shop
+
+"""Модуль кэширования ответов каталога (магазины, категории, товары)"""
+# Ключ кэша состоит из имени view, параметров запроса и версии каталога.
+# Версия магазина (Shop.catalog_version) увеличивается при импорте прайса и при изменении магазина,
+# поэтому после изменений запрос попадает в новый ключ и устаревшие данные не отдаются.
+# Дополнительно запись считается свежей CATALOG_CACHE_FRESH секунд: по истечении этого срока
+# она ещё отдаётся клиенту, а пересчитывается в фоновом потоке (stale-while-revalidate).
+# Ответы, зависящие не только от магазинов (список категорий), добавляют к версии свою (extra_version).
+# Ответы с остатками товаров (stock=True) добавляют к версии seq последней опубликованной записи журнала
+# изменений каталога: оформление и отмена заказа меняют остатки, не записывая в строку Shop, а запись журнала
+# публикуется после фиксации транзакции (см. publish_changes в backend/catalog.py).
+# Из версии и времени изменения каталога магазина строятся ETag и Last-Modified (для всего каталога - только ETag):
+# на условный запрос (If-None-Match / If-Modified-Since) с неизменившимся каталогом
+# сразу отдаётся 304 без обращения к кэшу и view.
+
+CATALOG_CACHE_FRESH = getattr(settings, 'CATALOG_CACHE_FRESH', 60)
+CATALOG_CACHE_TIMEOUT = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 60 * 60)
+
+
+def bump_catalog_version(shop_id):
+    """Увеличивает версию каталога магазина (вызывать в той же транзакции, что и изменение данных)"""
+    Shop.objects.filter(id=shop_id).update(catalog_version=F('catalog_version') + 1,
+                                           catalog_updated_at=timezone.now())
+
+
+def catalog_version(shop_id=None):
+    """
+    Версия каталога одного магазина или, если магазин не указан, всего каталога, и время его изменения
+    (только для магазина). Версия всего каталога меняется при изменении любого магазина,
+    а также при добавлении и удалении магазинов
+    """
+    if shop_id is not None:
+        version, updated_at = Shop.objects.filter(id=shop_id).values_list(
+            'catalog_version', 'catalog_updated_at').first() or (None, None)
+        return f'shop{shop_id}.{version}', updated_at
+    # у всего каталога времени изменения нет: удаление магазина или магазин без catalog_updated_at
+    # не сдвинули бы Max(catalog_updated_at), и If-Modified-Since получал бы устаревший 304.
+    # Такие ответы проверяются только по ETag
+    versions = Shop.objects.aggregate(total=Sum('catalog_version'), count=Count('id'), last=Max('id'))
+    return '{total}.{count}.{last}'.format(**versions), None
+
+
+def stock_version(shop_id=None):
+    """
+    seq и время публикации последней опубликованной записи журнала изменений магазина
+    или, если магазин не указан, всего каталога. Меняется при каждом изменении товаров, в т.ч. остатков
+    """
+    changes = CatalogChange.objects.filter(seq__isnull=False)
+    if shop_id is not None:
+        changes = changes.filter(shop_id=shop_id)
+    return changes.order_by('-seq').values_list('seq', 'published_at').first() or (0, None)
+
+
+def category_version():
+    """
+    Версия списка категорий: меняется при добавлении, удалении, переименовании категории
+    и изменении её магазинов (Category.updated_at)
+    """
+    versions = Category.objects.aggregate(count=Count('id'), last=Max('id'), updated=Max('updated_at'))
+    updated = versions['updated'].timestamp() if versions['updated'] else 0
+    return f'{versions["count"]}.{versions["last"]}.{updated:.6f}'
+
+
+def _revalidate(key, lock_key, compute):
+    try:
+        data = compute()
+        if data is not None:
+            cache.set(key, (data, time.time() + CATALOG_CACHE_FRESH), CATALOG_CACHE_TIMEOUT)
+    finally:
+        cache.delete(lock_key)
+        # у фонового потока своё соединение с БД, закрываем его
+        connection.close()
+
+
+def catalog_cache(shop_param=None, extra_version=None, stock=False):
+    """
+    Декоратор метода get() для кэширования ответа каталога.
+    shop_param - параметр запроса с id магазина: если он передан, ключ зависит только от версии этого магазина.
+    extra_version - функция, версия данных ответа помимо каталога магазинов (например, category_version).
+    stock - в ответе есть остатки товаров, ключ зависит и от stock_version()
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def inner_func(self, request, *args, **kwargs):
+            shop_id = request.GET.get(shop_param) if shop_param else None
+            shop_id = int(shop_id) if shop_id and shop_id.isdigit() else None
+            version, updated_at = catalog_version(shop_id)
+            if stock:
+                seq, published_at = stock_version(shop_id)
+                version = f'{version}.{seq}'
+                if updated_at is not None and published_at is not None:
+                    updated_at = max(updated_at, published_at)
+            if extra_version is not None:
+                version = f'{version}.{extra_version()}'
+            params = hashlib.md5(request.GET.urlencode().encode()).hexdigest()
+            key = f'catalog:{self.__class__.__name__}:{params}:{version}'
+
+            # условный запрос: ETag зависит от view, параметров и версии каталога
+            etag = '"%s"' % hashlib.md5(key.encode()).hexdigest()
+            last_modified = int(updated_at.timestamp()) if updated_at else None
+            not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if not_modified is not None:
+                return not_modified
+            response = _cached_response(self, request, func, key, *args, **kwargs)
+            if response.status_code == 200:
+                response['ETag'] = etag
+                if last_modified is not None:
+                    response['Last-Modified'] = http_date(last_modified)
+            return response
+        return inner_func
+    return decorator
+
+
+def _cached_response(self, request, func, key, *args, **kwargs):
+    """Ответ view из кэша (с фоновым пересчётом устаревшей записи) или вычисленный заново"""
+    def compute():
+        response = func(self, request, *args, **kwargs)
+        return response.data if response.status_code == 200 else None
+
+    entry = cache.get(key)
+    if entry is not None:
+        data, fresh_until = entry
+        # пересчёт устаревшей записи запускает только один поток
+        if fresh_until < time.time() and cache.add(f'{key}:lock', 1, CATALOG_CACHE_FRESH):
+            threading.Thread(target=_revalidate, args=(key, f'{key}:lock', compute), daemon=True).start()
+        return Response(data)
+
+    response = func(self, request, *args, **kwargs)
+    # потоковые ответы (?stream=true) не кэшируются
+    if response.status_code == 200 and not response.streaming:
+        cache.set(key, (response.data, time.time() + CATALOG_CACHE_FRESH), CATALOG_CACHE_TIMEOUT)
+    return response
@@ -0,0 +1,160 @@
+from django.db import connection, DatabaseError, transaction
+from django.db.models import Count, F, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from backend.models import CatalogChange, CatalogItem, ParameterFacet, ProductInfo, ProductParameter
+
+"""Модуль поддержки плоской модели чтения каталога (CatalogItem)"""
+# Строки CatalogItem пересобираются из ProductInfo/Product/Shop/ProductParameter при импорте прайса
+# (только для изменившихся товаров пачки), удаляются каскадом вместе с ProductInfo,
+# а данные магазина обновляются сигналом при сохранении Shop.
+# Там же пересчитываются фасеты характеристик (ParameterFacet) по категориям магазина
+# и ведётся журнал изменений каталога (CatalogChange): записи добавляются в транзакции изменения без seq
+# и без блокировок, а seq им выдаётся после фиксации (publish_changes), в порядке фиксации.
+
+# параметры запроса вида param.<имя параметра>=<значение>
+PARAMETER_PREFIX = 'param.'
+
+# ключ pg_advisory_xact_lock для выдачи seq записям журнала изменений каталога
+CHANGES_LOCK_NAMESPACE = 7302
+
+SHOP_FIELDS = {'shop_name': 'name', 'shop_url': 'url', 'shop_address': 'address', 'shop_state': 'state'}
+
+
+def refresh_catalog_items(product_info_ids):
+    """Пересобирает строки каталога для указанных товаров: два запроса на чтение и один на запись"""
+    product_info_ids = list(product_info_ids)
+    if not product_info_ids:
+        return 0
+    parameters = {}
+    for product_info_id, name, value in ProductParameter.objects.filter(
+            product_info_id__in=product_info_ids).order_by('id').values_list(
+            'product_info_id', 'parameter__name', 'value'):
+        parameters.setdefault(product_info_id, []).append({'parameter': name, 'value': value})
+
+    items = [CatalogItem(product_info_id=row['id'], shop_id=row['shop_id'],
+                         shop_name=row['shop__name'], shop_url=row['shop__url'],
+                         shop_address=row['shop__address'], shop_state=row['shop__state'],
+                         product_id=row['product_id'], product_name=row['product__name'],
+                         category_id=row['product__category_id'], model=row['model'],
+                         description=row['description'], quantity=row['quantity'],
+                         price=row['price'], price_rrc=row['price_rrc'],
+                         parameters=parameters.get(row['id'], []))
+             for row in ProductInfo.objects.filter(id__in=product_info_ids).values(
+                 'id', 'shop_id', 'shop__name', 'shop__url', 'shop__address', 'shop__state',
+                 'product_id', 'product__name', 'product__category_id', 'model', 'description',
+                 'quantity', 'price', 'price_rrc')]
+    CatalogItem.objects.filter(product_info_id__in=product_info_ids).delete()
+    CatalogItem.objects.bulk_create(items)
+    return len(items)
+
+
+def missing_catalog_items(product_info_ids):
+    """Товары из списка, для которых ещё нет строки каталога (например, загруженные до появления CatalogItem)"""
+    return set(product_info_ids) - set(CatalogItem.objects.filter(product_info_id__in=product_info_ids)
+                                       .values_list('product_info_id', flat=True))
+
+
+def sync_shop(shop):
+    """Переносит в каталог название, ссылку, адрес и статус магазина"""
+    return CatalogItem.objects.filter(shop_id=shop.id).update(
+        **{field: getattr(shop, shop_field) for field, shop_field in SHOP_FIELDS.items()})
+
+
+def rebuild_facets(shop_id):
+    """Пересчёт фасетов характеристик магазина по категориям (один запрос с группировкой на магазин)"""
+    rows = ProductParameter.objects.filter(product_info__shop_id=shop_id).values(
+        'product_info__product__category_id', 'parameter_id', 'value').annotate(count=Count('id')).order_by()
+    ParameterFacet.objects.filter(shop_id=shop_id).delete()
+    ParameterFacet.objects.bulk_create([ParameterFacet(shop_id=shop_id,
+                                                       category_id=row['product_info__product__category_id'],
+                                                       parameter_id=row['parameter_id'], value=row['value'],
+                                                       count=row['count'])
+                                        for row in rows], batch_size=1000)
+
+
+def parameter_filters(params):
+    """
+    Условие для CatalogItem по параметрам запроса param.<имя>=<значение>.
+    Несколько значений одного параметра объединяются через ИЛИ, разные параметры - через И
+    """
+    query = Q()
+    for key in params:
+        if key.startswith(PARAMETER_PREFIX) and key != PARAMETER_PREFIX:
+            query &= Q(pk__in=ProductParameter.objects.filter(
+                parameter__name=key[len(PARAMETER_PREFIX):], value__in=params.getlist(key)
+            ).values('product_info_id'))
+    return query
+
+
+def facet_counts(shop_id=None, category_id=None, parameters=Q()):
+    """
+    Количество товаров по значениям характеристик: {имя параметра: [{"value": ..., "count": ...}, ...]}.
+    Без фильтров по характеристикам берутся готовые счётчики ParameterFacet,
+    с фильтрами - считаются только по отобранным товарам
+    """
+    if parameters:
+        query = Q(shop_state=True) & parameters
+        if shop_id:
+            query &= Q(shop_id=shop_id)
+        if category_id:
+            query &= Q(category_id=category_id)
+        rows = ProductParameter.objects.filter(product_info_id__in=CatalogItem.objects.filter(query).values('pk')) \
+            .values('parameter__name', 'value').annotate(count=Count('id'))
+    else:
+        rows = ParameterFacet.objects.filter(shop__state=True)
+        if shop_id:
+            rows = rows.filter(shop_id=shop_id)
+        if category_id:
+            rows = rows.filter(category_id=category_id)
+        rows = rows.values('parameter__name', 'value').annotate(count=Sum('count'))
+    facets = {}
+    for row in rows.order_by('parameter__name', 'value'):
+        facets.setdefault(row['parameter__name'], []).append({'value': row['value'], 'count': row['count']})
+    return facets
+
+
+def record_changes(shop_id, action, product_info_ids):
+    """
+    Добавляет в журнал изменений каталога записи об изменении товаров (в той же транзакции, что и изменение).
+    Запись добавляется без seq и без блокировок, seq ей выдаёт publish_changes() после фиксации транзакции
+    """
+    product_info_ids = sorted(product_info_ids)
+    if not product_info_ids:
+        return
+    CatalogChange.objects.bulk_create([CatalogChange(shop_id=shop_id, product_info_id=product_info_id,
+                                                     action=action)
+                                       for product_info_id in product_info_ids], batch_size=1000)
+    transaction.on_commit(_publish_after_commit)
+
+
+def publish_changes():
+    """
+    Выдаёт seq зафиксированным записям журнала изменений, у которых его ещё нет, и возвращает их количество.
+    seq выдаётся одним UPDATE в короткой транзакции под блокировкой: публикации идут по очереди, каждая видит
+    seq всех предыдущих и выдаёт большие. Поэтому записи становятся видны клиентам (seq > since) строго
+    в порядке seq, а транзакции, изменяющие каталог, друг друга не ждут.
+    В SQLite пишущая транзакция и так блокирует всю базу до фиксации
+    """
+    unpublished = CatalogChange.objects.filter(seq__isnull=True)
+    if not unpublished.exists():
+        return 0
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s, 0)', [CHANGES_LOCK_NAMESPACE])
+        # seq = id + (последний seq - первый id без seq + 1): больше всех выданных, порядок id сохраняется.
+        # Записи незафиксированных транзакций в снимок UPDATE не попадают и получат seq при следующей публикации
+        last_seq = CatalogChange.objects.filter(seq__isnull=False).order_by('-seq').values('seq')[:1]
+        first_id = unpublished.order_by('id').values('id')[:1]
+        return unpublished.update(seq=F('id') + Coalesce(Subquery(last_seq), Value(0)) - Subquery(first_id) + 1,
+                                  published_at=timezone.now())
+
+
+def _publish_after_commit():
+    try:
+        publish_changes()
+    except DatabaseError:
+        # изменение уже зафиксировано, записи опубликует следующий вызов publish_changes()
+        pass
@@ -0,0 +1,137 @@
+from itertools import islice
+
+from rest_framework import serializers
+
+from backend.models import Contact, OrderItem, ProductInfo, ProductParameter
+
+"""Модуль быстрой сериализации больших списков каталога и заказов"""
+# Функции строят тот же JSON, что и сериализаторы DRF (CatalogItemSerializer, OrderSerializer,
+# OrderPartnerSerializer), но напрямую из строк .values() и словарей связей, загруженных одним запросом
+# на связь, без создания объекта модели и сериализатора на каждую строку.
+# Совпадение вывода с сериализаторами DRF проверяют команда manage.py bench_serializers и тесты.
+# Выбор полей (?fields=, ?expand=) здесь не поддерживается - такие запросы идут через сериализаторы DRF.
+# Функции iter_* отдают строки по одной для потоковой выдачи (см. backend/streaming.py).
+
+PRODUCT_INFO_VALUES = ('id', 'model', 'description', 'quantity', 'price_rrc', 'product_id', 'product__name',
+                       'product__category_id', 'shop_id', 'shop__name', 'shop__url', 'shop__address', 'shop__state')
+
+# pk и поля сортировки нужны курсору постраничной выдачи (KeysetPagination)
+CATALOG_ITEM_VALUES = ('pk', 'shop_id', 'shop_name', 'shop_url', 'shop_address', 'shop_state', 'product_id',
+                       'product_name', 'category_id', 'model', 'description', 'quantity', 'price', 'price_rrc',
+                       'parameters')
+
+ORDER_VALUES = ('id', 'status', 'date_time', 'contact_id', 'total_cost')
+
+# строк на пачку при чтении курсором и загрузке связей
+CHUNK_SIZE = 2000
+
+# тот же формат даты, что и у поля date_time в OrderSerializer
+_date_time = serializers.DateTimeField()
+
+
+def load_parameters(product_info_ids):
+    """Характеристики товаров одним запросом: {id товара: [{"parameter": имя, "value": значение}, ...]}"""
+    parameters = {}
+    for product_info_id, name, value in ProductParameter.objects.filter(
+            product_info_id__in=product_info_ids).values_list('product_info_id', 'parameter__name', 'value'):
+        parameters.setdefault(product_info_id, []).append({'parameter': name, 'value': value})
+    return parameters
+
+
+def _shop(row):
+    return {'id': row['shop_id'], 'name': row['shop__name'], 'url': row['shop__url'],
+            'address': row['shop__address'], 'state': row['shop__state']}
+
+
+def _product(row):
+    return {'id': row['product_id'], 'name': row['product__name'], 'category': row['product__category_id']}
+
+
+def product_info_shop_row(row, parameters):
+    """Строка PRODUCT_INFO_VALUES в виде ProductInfoShopSerializer (товар в составе заказа)"""
+    return {'id': row['id'], 'product': _product(row), 'shop': _shop(row), 'model': row['model'],
+            'description': row['description'], 'product_parameters': parameters.get(row['id'], [])}
+
+
+def catalog_item_row(row):
+    """Строка CATALOG_ITEM_VALUES в виде CatalogItemSerializer"""
+    return {'id': row['pk'],
+            'shop': {'id': row['shop_id'], 'name': row['shop_name'], 'url': row['shop_url'],
+                     'address': row['shop_address'], 'state': row['shop_state']},
+            'model': row['model'],
+            'product': {'id': row['product_id'], 'name': row['product_name'], 'category': row['category_id']},
+            'description': row['description'], 'quantity': row['quantity'], 'price_rrc': row['price_rrc'],
+            'product_parameters': row['parameters']}
+
+
+def order_row(order, items, product_infos, parameters):
+    """Заказ (строка ORDER_VALUES) с позициями items в виде OrderSerializer"""
+    return {'id': order['id'], 'status': order['status'],
+            'date_time': _date_time.to_representation(order['date_time']),
+            'ordered_items': [{'id': item['id'], 'quantity': item['quantity'],
+                               'product_info': product_info_shop_row(product_infos[item['product_info_id']],
+                                                                     parameters),
+                               'order': item['order_id']}
+                              for item in items],
+            'contact': order['contact_id'],
+            'total_cost': None if order['total_cost'] is None else int(order['total_cost'])}
+
+
+def _order_rows(orders):
+    """Заказы (строки ORDER_VALUES) с позициями: позиции, товары и характеристики - по одному запросу"""
+    items = {}
+    for item in OrderItem.objects.filter(order_id__in=[order['id'] for order in orders]).values(
+            'id', 'quantity', 'product_info_id', 'order_id'):
+        items.setdefault(item['order_id'], []).append(item)
+    product_info_ids = {item['product_info_id'] for order_items in items.values() for item in order_items}
+    product_infos = {row['id']: row for row in ProductInfo.objects.filter(id__in=product_info_ids)
+                     .values(*PRODUCT_INFO_VALUES)}
+    parameters = load_parameters(product_info_ids)
+    return [order_row(order, items.get(order['id'], []), product_infos, parameters) for order in orders]
+
+
+def serialize_orders(queryset):
+    """Аналог OrderSerializer(queryset, many=True).data для queryset с аннотацией total_cost"""
+    return _order_rows(list(queryset.prefetch_related(None).values(*ORDER_VALUES)))
+
+
+def chunks(rows, size=CHUNK_SIZE):
+    """Итератор по строкам пачками по size"""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def iter_catalog_items(queryset, chunk_size=CHUNK_SIZE):
+    """Строки каталога в виде CatalogItemSerializer, читаются курсором на стороне сервера БД"""
+    for row in queryset.values(*CATALOG_ITEM_VALUES).iterator(chunk_size=chunk_size):
+        yield catalog_item_row(row)
+
+
+def iter_orders(queryset, chunk_size=CHUNK_SIZE):
+    """Заказы в виде OrderSerializer: читаются курсором, связи загружаются на каждую пачку заказов"""
+    orders = queryset.prefetch_related(None).values(*ORDER_VALUES).iterator(chunk_size=chunk_size)
+    for chunk in chunks(orders, chunk_size):
+        yield from _order_rows(chunk)
+
+
+def iter_partner_items(queryset, chunk_size=CHUNK_SIZE):
+    """Позиции заказов поставщика (queryset с аннотацией order_item_cost) в виде OrderPartnerSerializer"""
+    rows = queryset.prefetch_related(None).values('order_id', 'product_info_id', 'quantity', 'order_item_cost',
+                                                  'order__contact_id').iterator(chunk_size=chunk_size)
+    for chunk in chunks(rows, chunk_size):
+        product_info_ids = {row['product_info_id'] for row in chunk}
+        product_infos = {row['id']: row for row in ProductInfo.objects.filter(id__in=product_info_ids)
+                         .values(*PRODUCT_INFO_VALUES)}
+        parameters = load_parameters(product_info_ids)
+        contacts = {contact.id: str(contact) for contact in
+                    Contact.objects.filter(id__in={row['order__contact_id'] for row in chunk})}
+        for row in chunk:
+            yield {'order': row['order_id'],
+                   'product_info': product_info_shop_row(product_infos[row['product_info_id']], parameters),
+                   'quantity': row['quantity'],
+                   'order_item_cost': int(row['order_item_cost']),
+                   'contact': contacts.get(row['order__contact_id'])}
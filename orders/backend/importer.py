@@ -0,0 +1,423 @@
+import csv
+import hashlib
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import django
+from django.db import connection, connections, transaction
+from django.utils import timezone
+from requests import get, RequestException
+from yaml import YAMLError
+
+from backend.basket import recalculate_order_totals
+from backend.cache import bump_catalog_version
+from backend.catalog import refresh_catalog_items, missing_catalog_items, rebuild_facets, record_changes
+from backend.models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, ImportJob, OrderItem
+from backend.price_parsers import get_price_parser, PriceFormatError
+
+"""Модуль пакетного импорта прайс-листов поставщиков"""
+# Вместо get_or_create/create на каждую строку прайса существующие записи ищутся
+# несколькими запросами на всю пачку товаров, а новые записываются через bulk_create.
+# Количество запросов к БД зависит от количества пачек, а не от количества товаров.
+# Товары магазина не пересоздаются: прайс сверяется с базой и применяются только изменения.
+# Каждая пачка пишется в своей транзакции, чтобы ход импорта был виден в задаче ImportJob.
+
+BATCH_SIZE = 1000
+
+# прайс до SPOOL_SIZE байт хранится в памяти, больше - во временном файле на диске
+SPOOL_SIZE = 8 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# пространство ключей pg_advisory_lock для блокировки импорта по магазину (ключ - id поставщика)
+LOCK_NAMESPACE = 7301
+
+# поля ProductInfo, которые обновляются из прайса
+UPDATE_FIELDS = ('product_id', 'model', 'description', 'price', 'price_rrc', 'quantity')
+
+
+def batches(iterable, size=BATCH_SIZE):
+    """Разбивает последовательность на пачки (списки) длиной не более size"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ResolutionCache:
+    """
+    Кэш ключ -> id для справочников (Category, Parameter, Product) на время импорта.
+    Загружается одним запросом в начале импорта и пополняется по мере добавления новых записей,
+    поэтому повторные имена ("Цвет", "Диагональ (дюйм)") не требуют запросов к БД
+    """
+
+    def __init__(self, queryset, key_fields, batch_size=BATCH_SIZE):
+        self.queryset = queryset
+        self.model = queryset.model
+        self.key_fields = key_fields
+        self.batch_size = batch_size
+        self.ids = {}
+
+    def _key(self, row):
+        return row[0] if len(self.key_fields) == 1 else tuple(row)
+
+    def _select(self, queryset):
+        self.ids.update((self._key(row[:-1]), row[-1]) for row in
+                        queryset.values_list(*self.key_fields, 'id').iterator())
+
+    def load(self):
+        self._select(self.queryset)
+        return self
+
+    def resolve(self, keys, build):
+        """
+        Возвращает словарь ключ -> id, создавая отсутствующие записи через build(key).
+        Запросы к БД выполняются, только если среди keys есть новые ключи
+        """
+        missing = set(keys) - self.ids.keys()
+        if missing:
+            # запись, добавленную параллельным импортом, пропускает ограничение уникальности,
+            # а её id дочитывается вместе с новыми
+            self.model.objects.bulk_create([build(key) for key in missing], batch_size=self.batch_size,
+                                           ignore_conflicts=True)
+            # не все СУБД возвращают id после bulk_create, поэтому дочитываем только новые записи
+            if len(self.key_fields) == 1:
+                lookups = {f'{self.key_fields[0]}__in': missing}
+            else:
+                lookups = {f'{field}__in': {key[index] for key in missing}
+                           for index, field in enumerate(self.key_fields)}
+            self._select(self.model.objects.filter(**lookups))
+        return self.ids
+
+
+class PriceImporter:
+    """
+    Пакетный импорт прайс-листа одного магазина.
+    Порядок работы: import_categories() -> import_goods()
+    """
+
+    def __init__(self, shop, batch_size=BATCH_SIZE, progress=None):
+        self.shop = shop
+        self.batch_size = batch_size
+        self.progress = progress  # вызывается с объектом импортёра после каждой пачки
+        self.processed = 0
+        self.created = 0
+        self.updated = 0
+        self.deleted = 0
+        self.parameters = ResolutionCache(Parameter.objects.all(), ('name',), batch_size).load()
+        self.categories = ResolutionCache(Category.objects.all(), ('id',), batch_size).load()
+        self.products = None  # загружается в import_categories() по категориям прайса
+
+    def import_categories(self, categories):
+        """Добавляем отсутствующие категории и привязываем их к магазину"""
+        categories = {int(category['id']): category['name'] for category in categories}
+        self.categories.resolve(categories, lambda category_id: Category(id=category_id,
+                                                                         name=categories[category_id]))
+        self.products = ResolutionCache(Product.objects.filter(category_id__in=categories),
+                                        ('name', 'category_id'), self.batch_size).load()
+        # связь категория - магазин (ManyToMany) добавляем одним запросом
+        through = Category.shop.through
+        linked = set(through.objects.filter(shop_id=self.shop.id).values_list('category_id', flat=True))
+        if categories.keys() - linked:
+            through.objects.bulk_create([through(category_id=category_id, shop_id=self.shop.id)
+                                         for category_id in categories.keys() - linked],
+                                        batch_size=self.batch_size, ignore_conflicts=True)
+            bump_catalog_version(self.shop.id)
+
+    def import_goods(self, goods):
+        """
+        Сверка товаров магазина с прайсом по id товара поставщика (goods[].id):
+        добавляются новые позиции, обновляются изменившиеся, удаляются отсутствующие в прайсе
+        """
+        seen = set()
+        for batch in batches(goods, self.batch_size):
+            with transaction.atomic():
+                changes = self.created + self.updated
+                seen.update(self._import_batch(batch))
+                # версия каталога меняется вместе с данными, в той же транзакции
+                if self.created + self.updated != changes:
+                    bump_catalog_version(self.shop.id)
+            self.processed += len(batch)
+            self._report()
+        # удаляем товары, которых больше нет в прайсе (включая старые записи без external_id)
+        stale = [product_info_id for product_info_id, external_id in
+                 ProductInfo.objects.filter(shop_id=self.shop.id).values_list('id', 'external_id').iterator()
+                 if external_id not in seen]
+        for batch in batches(stale, self.batch_size):
+            with transaction.atomic():
+                # позиции заказов с удаляемыми товарами удаляются каскадом, итоги этих заказов пересчитываем
+                order_ids = list(OrderItem.objects.filter(product_info_id__in=batch)
+                                 .values_list('order_id', flat=True).distinct())
+                self.deleted += ProductInfo.objects.filter(id__in=batch).delete()[1].get(ProductInfo._meta.label, 0)
+                recalculate_order_totals(order_ids)
+                record_changes(self.shop.id, 'deleted', batch)
+                bump_catalog_version(self.shop.id)
+            self._report()
+        # фасеты характеристик пересчитываем один раз после сверки всего прайса
+        if self.created or self.updated or self.deleted:
+            with transaction.atomic():
+                rebuild_facets(self.shop.id)
+
+    def _report(self):
+        if self.progress:
+            self.progress(self)
+
+    def _import_batch(self, items):
+        # при повторе id товара в прайсе берём последнюю запись
+        items = {int(item['id']): item for item in items}
+        products = self.products.resolve({(item['name'], int(item['category'])) for item in items.values()},
+                                         lambda key: Product(name=key[0], category_id=key[1]))
+        parameters = self.parameters.resolve({name for item in items.values() for name in item.get('parameters', {})},
+                                             lambda name: Parameter(name=name))
+
+        existing = {product_info.external_id: product_info for product_info in
+                    ProductInfo.objects.filter(shop_id=self.shop.id, external_id__in=items)}
+        to_create, to_update, repriced = [], [], []
+        for external_id, item in items.items():
+            fields = {'product_id': products[(item['name'], int(item['category']))],
+                      'model': item.get('model'),
+                      'description': item.get('description'),
+                      'price': item['price'],
+                      'price_rrc': item['price_rrc'],
+                      'quantity': item['quantity']}
+            product_info = existing.get(external_id)
+            if product_info is None:
+                to_create.append(ProductInfo(shop_id=self.shop.id, external_id=external_id, **fields))
+            elif any(getattr(product_info, name) != value for name, value in fields.items()):
+                if (product_info.price, product_info.price_rrc) != (fields['price'], fields['price_rrc']):
+                    repriced.append(product_info.id)
+                for name, value in fields.items():
+                    setattr(product_info, name, value)
+                to_update.append(product_info)
+
+        ProductInfo.objects.bulk_create(to_create, batch_size=self.batch_size)
+        ProductInfo.objects.bulk_update(to_update, UPDATE_FIELDS, batch_size=self.batch_size)
+        self.created += len(to_create)
+        if repriced:
+            # суммы заказов считаются по текущим ценам товаров
+            recalculate_order_totals(OrderItem.objects.filter(product_info_id__in=repriced).values('order_id'))
+
+        # не все СУБД возвращают id после bulk_create, поэтому перечитываем их одним запросом
+        product_infos = dict(ProductInfo.objects.filter(shop_id=self.shop.id, external_id__in=items)
+                             .values_list('external_id', 'id'))
+        changed = self._sync_parameters({product_infos[external_id]: {parameters[name]: str(value) for name, value
+                                                                      in item.get('parameters', {}).items()}
+                                         for external_id, item in items.items()})
+        # обновлённым считается товар с изменёнными полями или характеристиками
+        changed.update(product_info.id for product_info in to_update)
+        updated = changed.intersection(product_info.id for product_info in existing.values())
+        created = {product_infos[external_id] for external_id in items if external_id not in existing}
+        self.updated += len(updated)
+
+        # пересобираем строки каталога (CatalogItem) для новых и изменившихся товаров пачки
+        changed.update(created)
+        changed.update(missing_catalog_items(set(product_infos.values()) - changed))
+        refresh_catalog_items(changed)
+        record_changes(self.shop.id, 'created', created)
+        record_changes(self.shop.id, 'updated', updated)
+        return items.keys()
+
+    def _sync_parameters(self, wanted):
+        """
+        Приводит характеристики товаров к виду {product_info_id: {parameter_id: value}}.
+        Возвращает множество id товаров, у которых характеристики изменились
+        """
+        to_create, to_update, to_delete = [], [], []
+        current = {}
+        for product_parameter in ProductParameter.objects.filter(product_info_id__in=wanted):
+            current.setdefault(product_parameter.product_info_id, {})[product_parameter.parameter_id] = \
+                product_parameter
+        for product_info_id, values in wanted.items():
+            stored = current.get(product_info_id, {})
+            for parameter_id, value in values.items():
+                product_parameter = stored.get(parameter_id)
+                if product_parameter is None:
+                    to_create.append(ProductParameter(product_info_id=product_info_id,
+                                                      parameter_id=parameter_id, value=value))
+                elif product_parameter.value != value:
+                    product_parameter.value = value
+                    to_update.append(product_parameter)
+            to_delete.extend(stored_parameter.id for parameter_id, stored_parameter in stored.items()
+                             if parameter_id not in values)
+
+        ProductParameter.objects.bulk_create(to_create, batch_size=self.batch_size)
+        ProductParameter.objects.bulk_update(to_update, ['value'], batch_size=self.batch_size)
+        if to_delete:
+            ProductParameter.objects.filter(id__in=to_delete).delete()
+        return {product_parameter.product_info_id for product_parameter in to_create + to_update} | \
+            {product_info_id for product_info_id, stored in current.items()
+             if stored.keys() - wanted[product_info_id].keys()}
+
+
+@contextmanager
+def shop_lock(user_id):
+    """
+    Блокировка записи прайса одного магазина (магазин связан с поставщиком один к одному).
+    Импорты разных магазинов идут параллельно, импорты одного магазина - по очереди.
+    В PostgreSQL используется сессионный advisory lock, для остальных СУБД - файловая блокировка
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock(%s, %s)', [LOCK_NAMESPACE, user_id])
+        try:
+            yield
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [LOCK_NAMESPACE, user_id])
+    else:
+        import fcntl
+        path = os.path.join(tempfile.gettempdir(), f'orders-import-{LOCK_NAMESPACE}-{user_id}.lock')
+        with open(path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def import_price(data, user_id, batch_size=BATCH_SIZE, progress=None, shop=None):
+    """
+    Импорт прайс-листа (словарь shop/categories/goods) от имени поставщика.
+    shop - магазин, в который загружается прайс; если не указан, магазин ищется по названию из прайса
+    или создаётся. Прайс другого магазина в указанный магазин не загружается (ShopMismatchError)
+    """
+    if shop is None:
+        shop, _ = Shop.objects.get_or_create(name=data['shop'], user_id=user_id)
+    elif data['shop'] != shop.name:
+        raise ShopMismatchError(f'Прайс магазина "{data["shop"]}" нельзя загрузить в магазин "{shop.name}"')
+    importer = PriceImporter(shop, batch_size=batch_size, progress=progress)
+    with transaction.atomic():
+        importer.import_categories(data['categories'])
+    importer.import_goods(data['goods'])
+    return importer
+
+
+class PriceImportError(Exception):
+    """Ошибка загрузки или разбора прайс-листа"""
+
+
+class ShopMismatchError(PriceImportError):
+    """Название магазина в прайсе не совпадает с магазином, в который загружается прайс"""
+
+
+def download_price(url, shop=None):
+    """
+    Загрузка прайса во временный файл (большие файлы уходят на диск) с подсчётом SHA-256.
+    Если прайс по этой ссылке уже загружался, запрос отправляется с If-None-Match/If-Modified-Since.
+    Возвращает (файл, ответ) или (None, ответ), если прайс не изменился
+    """
+    headers = {}
+    if shop is not None and shop.price_url == url:
+        if shop.price_etag:
+            headers['If-None-Match'] = shop.price_etag
+        if shop.price_last_modified:
+            headers['If-Modified-Since'] = shop.price_last_modified
+
+    with get(url, stream=True, headers=headers) as response:
+        if response.status_code == 304:
+            return None, response
+        if not response.ok:
+            raise PriceImportError(f'Ошибка загрузки прайса: {response.status_code}')
+        file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        digest = hashlib.sha256()
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            digest.update(chunk)
+            file.write(chunk)
+    file.seek(0)
+    file.sha256 = digest.hexdigest()
+    if shop is not None and shop.price_hash == file.sha256:
+        file.close()
+        return None, response
+    return file, response
+
+
+def import_price_url(url, user_id, progress=None, shop=None):
+    """
+    Загрузка прайса по ссылке и импорт в магазин shop (по умолчанию - магазин поставщика).
+    Файл читается потоком и не держится в памяти целиком.
+    Возвращает None, если прайс не изменился с прошлой загрузки (разбор и запись в базу пропускаются)
+    """
+    if shop is None:
+        shop = Shop.objects.filter(user_id=user_id).first()
+    try:
+        file, response = download_price(url, shop)
+        if file is None:
+            return None
+        # формат (YAML, JSON, NDJSON, CSV) определяется по Content-Type или расширению файла,
+        # товары из раздела goods разбираются по одному и сразу уходят пачками в базу
+        parser = get_price_parser(response.headers.get('Content-Type'), url)
+        with file, shop_lock(user_id):
+            importer = import_price(parser(file), user_id, progress=progress, shop=shop)
+            Shop.objects.filter(id=importer.shop.id).update(
+                price_url=url, price_etag=response.headers.get('ETag', ''),
+                price_last_modified=response.headers.get('Last-Modified', ''), price_hash=file.sha256)
+    except (RequestException, YAMLError, PriceFormatError, csv.Error) as error:
+        raise PriceImportError(str(error)) from error
+    return importer
+
+
+def claim_import_job():
+    """
+    Забирает из очереди следующую задачу импорта.
+    Задачу получает только один воркер: смена статуса queued -> running проверяется в самом UPDATE
+    """
+    for job_id in ImportJob.objects.filter(state='queued').order_by('id').values_list('id', flat=True)[:10]:
+        if ImportJob.objects.filter(id=job_id, state='queued').update(state='running', started_at=timezone.now()):
+            return ImportJob.objects.get(id=job_id)
+    return None
+
+
+def run_import_job(job):
+    """Выполнение задачи импорта с сохранением хода выполнения и результата в ImportJob"""
+    def progress(importer):
+        ImportJob.objects.filter(id=job.id).update(shop=importer.shop, processed=importer.processed,
+                                                   created=importer.created, updated=importer.updated,
+                                                   deleted=importer.deleted)
+
+    job.refresh_from_db()
+    try:
+        importer = import_price_url(job.url, job.user_id, progress=progress, shop=job.shop)
+    except Exception as error:
+        job.state = 'failed'
+        job.error = str(error)
+    else:
+        if importer is None:
+            job.state = 'not_modified'
+        else:
+            job.state = 'done'
+            job.shop = importer.shop
+            job.processed, job.created = importer.processed, importer.created
+            job.updated, job.deleted = importer.updated, importer.deleted
+    job.finished_at = timezone.now()
+    job.save()
+    return job
+
+
+def _init_pool_worker():
+    # при запуске процессов методом spawn Django в дочернем процессе нужно инициализировать заново
+    django.setup()
+
+
+def _run_import_job_by_id(job_id):
+    job = run_import_job(ImportJob.objects.get(id=job_id))
+    return job.id, job.state
+
+
+def run_import_jobs(jobs, processes=None):
+    """
+    Параллельное выполнение задач импорта в пуле процессов (по задаче на процесс).
+    Разбор прайсов идёт на всех ядрах, запись в базу по одному магазину - под shop_lock()
+    """
+    job_ids = []
+    for job in jobs:
+        if ImportJob.objects.filter(id=job.id, state='queued').update(state='running', started_at=timezone.now()):
+            job_ids.append(job.id)
+    # соединения с БД не должны наследоваться дочерними процессами
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_pool_worker) as pool:
+        return dict(pool.map(_run_import_job_by_id, job_ids))
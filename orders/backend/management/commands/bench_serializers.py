@@ -0,0 +1,149 @@
+import gc
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from backend.fast_serializers import CATALOG_ITEM_VALUES, PRODUCT_INFO_VALUES, catalog_item_row, order_row
+from backend.models import CatalogItem, Order, OrderItem, Parameter, Product, ProductInfo, ProductParameter, Shop
+from backend.serializers import CatalogItemSerializer, OrderSerializer
+
+SHOPS = 20
+PRODUCTS = 5000
+PARAMETERS = ('Диагональ (дюйм)', 'Разрешение (пикс)', 'Встроенная память (Гб)', 'Цвет')
+ITEMS_PER_ORDER = 10
+
+
+def timed(func):
+    """Время выполнения func; сборщик мусора на время замера отключается, иначе он искажает результат"""
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        result = func()
+        return result, time.perf_counter() - started
+    finally:
+        gc.enable()
+
+
+class Command(BaseCommand):
+    help = 'Сравнение быстрой сериализации (backend/fast_serializers.py) с сериализаторами DRF ' \
+           'на синтетических данных в памяти: время и совпадение JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[1000, 100000, 1000000],
+                            help='количество товаров (для заказов - позиций заказов) в прогоне')
+        parser.add_argument('--chunk', type=int, default=10000,
+                            help='данные создаются и сериализуются пачками, чтобы 1M строк не держать в памяти')
+
+    def handle(self, *args, **options):
+        shops = [Shop(id=number, name=f'Магазин {number}', url=f'https://shop{number}.ru/price.yaml',
+                      address=None, state=True) for number in range(1, SHOPS + 1)]
+        products = [Product(id=number, name=f'Смартфон {number}', category_id=200 + number % 30)
+                    for number in range(1, PRODUCTS + 1)]
+        parameters = [Parameter(id=number, name=name) for number, name in enumerate(PARAMETERS, start=1)]
+        self.data = shops, products, parameters
+
+        self.stdout.write(f'{"данные":<10}{"строк":>10}{"DRF, с":>10}{"быстро, с":>12}{"ускорение":>11}  JSON')
+        for rows in options['rows']:
+            for name, bench in (('каталог', self.bench_catalog), ('заказы', self.bench_orders)):
+                slow = fast = 0
+                for start in range(0, rows, options['chunk']):
+                    slow_chunk, fast_chunk = bench(start, min(rows, start + options['chunk']))
+                    slow += slow_chunk
+                    fast += fast_chunk
+                self.stdout.write(f'{name:<10}{rows:>10}{slow:>10.2f}{fast:>12.2f}{slow / fast:>10.1f}x  совпадает')
+
+    def product_info(self, number):
+        shops, products, parameters = self.data
+        product_info = ProductInfo(id=number, model=f'model/{number}', description=None if number % 3 else 'есть',
+                                   quantity=number % 50, price=1000 + number % 90000,
+                                   price_rrc=1100 + number % 90000)
+        product_info.shop = shops[number % len(shops)]
+        product_info.product = products[number % len(products)]
+        product_parameters = []
+        for offset, parameter in enumerate(parameters):
+            product_parameter = ProductParameter(id=number * len(parameters) + offset, product_info_id=number,
+                                                 value=str(number % (offset + 7)))
+            product_parameter.parameter = parameter
+            product_parameters.append(product_parameter)
+        product_info._prefetched_objects_cache = {'product_parameters': product_parameters}
+        return product_info
+
+    @staticmethod
+    def values(product_info):
+        """Строка PRODUCT_INFO_VALUES и характеристики - в том виде, в котором их отдаёт БД"""
+        row = {'id': product_info.id, 'model': product_info.model, 'description': product_info.description,
+               'quantity': product_info.quantity, 'price_rrc': product_info.price_rrc,
+               'product_id': product_info.product.id, 'product__name': product_info.product.name,
+               'product__category_id': product_info.product.category_id, 'shop_id': product_info.shop.id,
+               'shop__name': product_info.shop.name, 'shop__url': product_info.shop.url,
+               'shop__address': product_info.shop.address, 'shop__state': product_info.shop.state}
+        assert tuple(row) == PRODUCT_INFO_VALUES
+        parameters = [{'parameter': product_parameter.parameter.name, 'value': product_parameter.value}
+                      for product_parameter in product_info._prefetched_objects_cache['product_parameters']]
+        return row, parameters
+
+    def compare(self, slow_data, fast_data):
+        if JSONRenderer().render(slow_data) != JSONRenderer().render(fast_data):
+            raise CommandError('Вывод быстрой сериализации отличается от сериализатора DRF')
+
+    @staticmethod
+    def catalog_item(product_info):
+        """Строка модели чтения каталога (CatalogItem) и её строка CATALOG_ITEM_VALUES, как их отдаёт БД"""
+        shop, product = product_info.shop, product_info.product
+        parameters = [{'parameter': product_parameter.parameter.name, 'value': product_parameter.value}
+                      for product_parameter in product_info._prefetched_objects_cache['product_parameters']]
+        row = {'pk': product_info.id, 'shop_id': shop.id, 'shop_name': shop.name, 'shop_url': shop.url,
+               'shop_address': shop.address, 'shop_state': shop.state, 'product_id': product.id,
+               'product_name': product.name, 'category_id': product.category_id, 'model': product_info.model,
+               'description': product_info.description, 'quantity': product_info.quantity,
+               'price': product_info.price, 'price_rrc': product_info.price_rrc, 'parameters': parameters}
+        assert tuple(row) == CATALOG_ITEM_VALUES
+        fields = dict(row, product_info_id=row['pk'])
+        del fields['pk']
+        return CatalogItem(**fields), row
+
+    def bench_catalog(self, start, end):
+        items, rows = [], []
+        for number in range(start + 1, end + 1):
+            item, row = self.catalog_item(self.product_info(number))
+            items.append(item)
+            rows.append(row)
+
+        slow_data, slow = timed(lambda: CatalogItemSerializer(items, many=True).data)
+        fast_data, fast = timed(lambda: [catalog_item_row(row) for row in rows])
+
+        self.compare(slow_data, fast_data)
+        return slow, fast
+
+    def bench_orders(self, start, end):
+        now = timezone.make_aware(datetime(2023, 1, 1))
+        orders, order_values, items, product_infos, parameters = [], [], {}, {}, {}
+        for order_start in range(start, end, ITEMS_PER_ORDER):
+            order_id = order_start // ITEMS_PER_ORDER + 1
+            order = Order(id=order_id, status='new', date_time=now + timedelta(seconds=order_id), contact_id=order_id)
+            ordered_items = []
+            for number in range(order_start + 1, min(end, order_start + ITEMS_PER_ORDER) + 1):
+                product_info = self.product_info(number)
+                row, parameters[number] = self.values(product_info)
+                product_infos[number] = row
+                ordered_item = OrderItem(id=number, quantity=number % 5 + 1, order_id=order_id)
+                ordered_item.product_info = product_info
+                ordered_items.append(ordered_item)
+                items.setdefault(order_id, []).append({'id': number, 'quantity': ordered_item.quantity,
+                                                       'product_info_id': number, 'order_id': order_id})
+            order._prefetched_objects_cache = {'ordered_items': ordered_items}
+            order.total_cost = sum(item.quantity * item.product_info.price_rrc for item in ordered_items)
+            orders.append(order)
+            order_values.append({'id': order.id, 'status': order.status, 'date_time': order.date_time,
+                                 'contact_id': order.contact_id, 'total_cost': order.total_cost})
+
+        slow_data, slow = timed(lambda: OrderSerializer(orders, many=True).data)
+        fast_data, fast = timed(lambda: [order_row(order, items[order['id']], product_infos, parameters)
+                                         for order in order_values])
+
+        self.compare(slow_data, fast_data)
+        return slow, fast
@@ -0,0 +1,45 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.validators import URLValidator
+
+from backend.importer import run_import_jobs
+from backend.models import ImportJob, Shop, User
+
+
+class Command(BaseCommand):
+    help = 'Параллельный импорт прайсов нескольких магазинов: import_prices SHOP URL [SHOP URL ...], ' \
+           'где SHOP - id магазина или email поставщика'
+
+    def add_arguments(self, parser):
+        parser.add_argument('pairs', nargs='+', metavar='SHOP URL')
+        parser.add_argument('--processes', type=int, default=None,
+                            help='Количество процессов (по умолчанию - по числу ядер)')
+
+    def handle(self, *args, **options):
+        pairs = options['pairs']
+        if len(pairs) % 2:
+            raise CommandError('Аргументы передаются парами: SHOP URL')
+
+        jobs = []
+        validate_url = URLValidator()
+        for shop, url in zip(pairs[::2], pairs[1::2]):
+            # по id прайс загружается в выбранный магазин, по email - в магазин поставщика
+            if shop.isdigit():
+                user_id, shop_id = Shop.objects.filter(id=shop, user__isnull=False).values_list(
+                    'user_id', 'id').first() or (None, None)
+            else:
+                user_id, shop_id = User.objects.filter(email=shop, type='seller').values_list(
+                    'id', 'shops').first() or (None, None)
+            if user_id is None:
+                raise CommandError(f'Магазин (поставщик) {shop} не найден')
+            try:
+                validate_url(url)
+            except ValidationError as error:
+                raise CommandError(f'{url}: {error.messages[0]}')
+            jobs.append(ImportJob(user_id=user_id, shop_id=shop_id, url=url))
+
+        jobs = [ImportJob.objects.create(user_id=job.user_id, shop_id=job.shop_id, url=job.url) for job in jobs]
+        results = run_import_jobs(jobs, processes=options['processes'])
+        for job in ImportJob.objects.filter(id__in=results).order_by('id'):
+            self.stdout.write(f'{job.id} {job.url}: {job.state}, добавлено {job.created}, обновлено {job.updated}, '
+                              f'удалено {job.deleted}, {job.duration or 0:.1f} с. {job.error}'.rstrip())
@@ -0,0 +1,44 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from backend.importer import claim_import_job, run_import_job
+
+
+class Command(BaseCommand):
+    help = 'Воркер фонового импорта прайс-листов: выполняет задачи ImportJob из очереди'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sleep', type=float, default=2,
+                            help='Пауза (сек.) между проверками очереди, когда задач нет')
+        parser.add_argument('--once', action='store_true',
+                            help='Выполнить все задачи из очереди и завершиться')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Количество процессов-воркеров (импорты разных магазинов идут параллельно)')
+
+    def handle(self, *args, **options):
+        if options['processes'] <= 1:
+            return self.work(options['once'], options['sleep'])
+
+        # соединения с БД не должны наследоваться дочерними процессами
+        connections.close_all()
+        workers = [multiprocessing.Process(target=self.work, args=(options['once'], options['sleep']))
+                   for _ in range(options['processes'])]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def work(self, once, sleep):
+        while True:
+            job = claim_import_job()
+            if job is None:
+                if once:
+                    return
+                time.sleep(sleep)
+                continue
+            self.stdout.write(f'Импорт {job.url} (задача {job.id})')
+            job = run_import_job(job)
+            self.stdout.write(f'Задача {job.id}: {job.state} {job.error}'.rstrip())
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min
+
+from backend.cache import bump_catalog_version
+from backend.catalog import rebuild_facets, refresh_catalog_items
+from backend.importer import batches
+from backend.models import Parameter, Product, ProductInfo, ProductParameter
+
+
+class Command(BaseCommand):
+    help = 'Объединение дублей справочников Product (name, category) и Parameter (name). ' \
+           'Выполнить перед применением миграции с ограничениями unique_product и unique_parameter_name'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            product_info_ids = set()
+            merged_products = self.merge(Product, ('name', 'category_id'), ProductInfo, 'product_id', 'id',
+                                         product_info_ids)
+            merged_parameters = self.merge(Parameter, ('name',), ProductParameter, 'parameter_id', 'product_info_id',
+                                           product_info_ids)
+            # у товара могли оказаться две характеристики с одним параметром - оставляем первую
+            duplicates = ProductParameter.objects.order_by().values('product_info_id', 'parameter_id') \
+                .annotate(first=Min('id'), count=Count('id')).filter(count__gt=1)
+            for row in duplicates:
+                ProductParameter.objects.filter(product_info_id=row['product_info_id'],
+                                                parameter_id=row['parameter_id']).exclude(id=row['first']).delete()
+
+            for batch in batches(sorted(product_info_ids)):
+                refresh_catalog_items(batch)
+            for shop_id in set(ProductInfo.objects.filter(id__in=product_info_ids)
+                               .values_list('shop_id', flat=True)):
+                rebuild_facets(shop_id)
+                bump_catalog_version(shop_id)
+        self.stdout.write(f'Объединено продуктов: {merged_products}, параметров: {merged_parameters}')
+
+    @staticmethod
+    def merge(model, key_fields, related_model, related_field, product_info_field, product_info_ids):
+        """Ссылки related_model на дубли model переносятся на запись с наименьшим id, дубли удаляются"""
+        merged = 0
+        groups = model.objects.order_by().values(*key_fields).annotate(first=Min('id'), count=Count('id')) \
+            .filter(count__gt=1)
+        for group in groups:
+            duplicates = list(model.objects.filter(**{field: group[field] for field in key_fields})
+                              .exclude(id=group['first']).values_list('id', flat=True))
+            related = related_model.objects.filter(**{f'{related_field}__in': duplicates})
+            product_info_ids.update(related.values_list(product_info_field, flat=True))
+            related.update(**{related_field: group['first']})
+            model.objects.filter(id__in=duplicates).delete()
+            merged += len(duplicates)
+        return merged
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from backend.cache import bump_catalog_version
+from backend.catalog import refresh_catalog_items, rebuild_facets
+from backend.importer import batches
+from backend.models import ProductInfo, Shop
+
+
+class Command(BaseCommand):
+    help = 'Полная пересборка модели чтения каталога (CatalogItem) и фасетов характеристик из ProductInfo'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shop', type=int, action='append', help='id магазина (можно указать несколько раз)')
+
+    def handle(self, *args, **options):
+        shops = Shop.objects.all()
+        if options['shop']:
+            shops = shops.filter(id__in=options['shop'])
+        for shop in shops:
+            rows = 0
+            product_info_ids = ProductInfo.objects.filter(shop_id=shop.id).order_by('id') \
+                .values_list('id', flat=True).iterator()
+            for batch in batches(product_info_ids):
+                with transaction.atomic():
+                    rows += refresh_catalog_items(batch)
+            with transaction.atomic():
+                rebuild_facets(shop.id)
+            bump_catalog_version(shop.id)
+            self.stdout.write(f'{shop.name}: {rows}')
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from backend.basket import recalculate_order_totals
+from backend.importer import batches
+from backend.models import Order
+
+
+class Command(BaseCommand):
+    help = 'Пересчёт итогов заказов (Order.items_count, items_cost, items_cost_rrc) по их позициям'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--order', type=int, action='append', help='id заказа (можно указать несколько раз)')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.all()
+        if options['order']:
+            orders = orders.filter(id__in=options['order'])
+        updated = 0
+        for batch in batches(orders.order_by('id').values_list('id', flat=True).iterator()):
+            with transaction.atomic():
+                updated += recalculate_order_totals(batch)
+        self.stdout.write(f'Пересчитано заказов: {updated}')
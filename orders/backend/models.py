@@ -2,6 +2,7 @@ from django.contrib.auth.validators import UnicodeUsernameValidator
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.base_user import BaseUserManager
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django_rest_passwordreset.tokens import get_token_generator
 
@@ -15,6 +16,20 @@ STATUS_CHOICES = (
     ('basket', 'В корзине')
 )
 
+IMPORT_STATE_CHOICES = (
+    ('queued', 'В очереди'),
+    ('running', 'Выполняется'),
+    ('done', 'Выполнен'),
+    ('not_modified', 'Прайс не изменился'),
+    ('failed', 'Ошибка'),
+)
+
+CATALOG_CHANGE_CHOICES = (
+    ('created', 'Добавлен'),
+    ('updated', 'Изменён'),
+    ('deleted', 'Удалён'),
+)
+
 USER_TYPE_CHOICES = (
     ('seller', 'Продавец'),
     ('buyer', 'Покупатель'),
@@ -126,6 +141,14 @@ class Shop(models.Model):
                                 blank=True, null=True, related_name='shops',
                                 on_delete=models.CASCADE)
     state = models.BooleanField(verbose_name="Статус", default=True)
+    # данные последнего загруженного прайса, для повторных запросов с If-None-Match/If-Modified-Since
+    price_url = models.URLField(verbose_name="Ссылка на последний прайс", null=True, blank=True)
+    price_etag = models.CharField(max_length=256, verbose_name="ETag прайса", blank=True)
+    price_last_modified = models.CharField(max_length=64, verbose_name="Last-Modified прайса", blank=True)
+    price_hash = models.CharField(max_length=64, verbose_name="SHA-256 содержимого прайса", blank=True)
+    # увеличивается при каждом изменении каталога магазина, входит в ключ кэша каталога (см. backend/cache.py)
+    catalog_version = models.PositiveIntegerField(verbose_name="Версия каталога", default=1)
+    catalog_updated_at = models.DateTimeField(verbose_name="Время изменения каталога", null=True, blank=True)
 
     class Meta:
         verbose_name = "Магазин"
@@ -138,6 +161,8 @@ class Shop(models.Model):
 class Category(models.Model):
     name = models.CharField(max_length=64, verbose_name="Название категории")
     shop = models.ManyToManyField(Shop, verbose_name="Магазины", blank=True)
+    # входит в ключ кэша списка категорий (см. backend/cache.py)
+    updated_at = models.DateTimeField(verbose_name="Время изменения", auto_now=True)
 
     class Meta:
         verbose_name = "Категория"
@@ -158,6 +183,8 @@ class Product(models.Model):
         verbose_name = "Продукт"
         verbose_name_plural = "Список продуктов"
         ordering = ("-name",)
+        # справочник общий для всех магазинов: параллельные импорты не должны создавать дубли
+        constraints = [models.UniqueConstraint(fields=['name', 'category'], name='unique_product')]
 
     def __str__(self):
         return self.name
@@ -167,6 +194,8 @@ class ProductInfo(models.Model):
                                 blank=True, on_delete=models.CASCADE)
     shop = models.ForeignKey(Shop, verbose_name="Магазин", related_name="product_info", blank=True,
                              on_delete=models.CASCADE)
+    external_id = models.PositiveIntegerField(verbose_name="Внешний ID (id товара в прайсе поставщика)",
+                                              null=True, blank=True)
     model = models.CharField(max_length=128, verbose_name="Производитель/Модель", null=True, blank=True)
     description = models.CharField(max_length=256, verbose_name="Описание", null=True, blank=True)
     quantity = models.PositiveIntegerField(verbose_name="Количество")
@@ -176,11 +205,76 @@ class ProductInfo(models.Model):
     class Meta:
         verbose_name = 'Информация о продукте'
         verbose_name_plural = "Информация о продуктах"
-        constraints = [models.UniqueConstraint(fields=['product', 'shop'], name='unique_product_info')]
+        # товар магазина однозначно определяется id из прайса поставщика (по нему идёт сверка при импорте)
+        constraints = [models.UniqueConstraint(fields=['shop', 'external_id'], name='unique_product_info')]
 
     # def __str__(self):
     #     return self.product
 
+class CatalogItem(models.Model):
+    """
+    Плоская модель чтения каталога: одна строка на предложение магазина (ProductInfo)
+    с данными магазина, продукта и характеристиками в JSON. Каталог читается из неё без join и prefetch.
+    Поддерживается импортом прайса и сигналами изменения магазина (см. backend/catalog.py)
+    """
+    product_info = models.OneToOneField(ProductInfo, verbose_name="Информация о продукте", primary_key=True,
+                                        related_name="catalog_item", on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name="Магазин", related_name="catalog_items", on_delete=models.CASCADE)
+    shop_name = models.CharField(max_length=64, verbose_name='Название магазина')
+    shop_url = models.URLField(verbose_name="Ссылка", null=True, blank=True)
+    shop_address = models.CharField(max_length=128, verbose_name="Адрес магазина", null=True, blank=True)
+    shop_state = models.BooleanField(verbose_name="Статус магазина", default=True)
+    product = models.ForeignKey(Product, verbose_name="Продукт", related_name="catalog_items",
+                                on_delete=models.CASCADE)
+    product_name = models.CharField(max_length=80, verbose_name="Название")
+    category_id = models.IntegerField(verbose_name="Категория")
+    model = models.CharField(max_length=128, verbose_name="Производитель/Модель", null=True, blank=True)
+    description = models.CharField(max_length=256, verbose_name="Описание", null=True, blank=True)
+    quantity = models.PositiveIntegerField(verbose_name="Количество")
+    price = models.PositiveIntegerField(verbose_name="Цена")
+    price_rrc = models.PositiveIntegerField(verbose_name="Рекомендуемая розничная цена")
+    # [{"parameter": имя, "value": значение}, ...] - в том же виде, что отдаёт ProductParameterSerializer
+    parameters = models.JSONField(verbose_name="Характеристики", default=list)
+
+    class Meta:
+        verbose_name = 'Позиция каталога'
+        verbose_name_plural = "Каталог (модель чтения)"
+        # индексы под фильтры и сортировки каталога (?category_id=, ?shop_id=, ?price_min/max=, ?ordering=):
+        # страница читается диапазоном индекса в нужном порядке, без сортировки всей выборки
+        indexes = [models.Index(fields=['shop_state', 'product_info']),
+                   models.Index(fields=['category_id', 'shop_state', 'product_info']),
+                   models.Index(fields=['shop_state', 'price', 'product_info']),
+                   models.Index(fields=['category_id', 'shop_state', 'price', 'product_info']),
+                   models.Index(fields=['shop', 'price', 'product_info']),
+                   models.Index(fields=['shop_state', 'price_rrc', 'product_info']),
+                   models.Index(fields=['shop_state', 'quantity', 'product_info'])]
+
+
+class CatalogChange(models.Model):
+    """
+    Журнал изменений каталога (только добавление записей): добавление, изменение и удаление предложений
+    (ProductInfo) при импорте прайса. seq монотонно растёт, по нему клиенты забирают изменения
+    с момента последней синхронизации. seq выдаётся после фиксации транзакции, добавившей запись
+    (см. publish_changes в backend/catalog.py), до этого запись клиентам не видна
+    """
+    id = models.BigAutoField(primary_key=True)
+    seq = models.BigIntegerField(verbose_name="Номер изменения", null=True, blank=True, unique=True)
+    published_at = models.DateTimeField(verbose_name="Время публикации", null=True, blank=True)
+    shop = models.ForeignKey(Shop, verbose_name="Магазин", related_name="catalog_changes", on_delete=models.CASCADE)
+    # не внешний ключ: запись об удалении должна пережить удалённый ProductInfo
+    product_info_id = models.IntegerField(verbose_name="Информация о продукте")
+    action = models.CharField(max_length=10, verbose_name="Изменение", choices=CATALOG_CHANGE_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Изменение каталога'
+        verbose_name_plural = "Журнал изменений каталога"
+        indexes = [models.Index(fields=['shop', 'seq']),
+                   # записи, ещё не получившие seq
+                   models.Index(fields=['id'], condition=models.Q(seq__isnull=True),
+                                name='catalog_change_unpublished')]
+
+
 class Parameter(models.Model):
     name = models.CharField(max_length=32, verbose_name="Имя параметра")
 
@@ -188,6 +282,7 @@ class Parameter(models.Model):
         verbose_name = 'Имя параметра'
         verbose_name_plural = "Список имен параметров"
         ordering = ('-name',)
+        constraints = [models.UniqueConstraint(fields=['name'], name='unique_parameter_name')]
 
     def __str__(self):
         return self.name
@@ -199,6 +294,31 @@ class ProductParameter(models.Model):
                                   blank=True, on_delete=models.CASCADE)
     value = models.CharField(max_length=64, verbose_name="Значение")
 
+    class Meta:
+        # фильтр каталога param.<имя>=<значение> выбирает товары по паре (параметр, значение)
+        indexes = [models.Index(fields=['parameter', 'value'])]
+
+
+class ParameterFacet(models.Model):
+    """
+    Количество товаров с данным значением характеристики в категории магазина.
+    Пересчитывается при импорте прайса, чтобы фасеты не считались по ProductParameter на каждый запрос
+    """
+    shop = models.ForeignKey(Shop, verbose_name="Магазин", related_name="parameter_facets", on_delete=models.CASCADE)
+    category_id = models.IntegerField(verbose_name="Категория")
+    parameter = models.ForeignKey(Parameter, verbose_name="Параметр", related_name="facets",
+                                  on_delete=models.CASCADE)
+    value = models.CharField(max_length=64, verbose_name="Значение")
+    count = models.PositiveIntegerField(verbose_name="Количество товаров")
+
+    class Meta:
+        verbose_name = 'Фасет характеристики'
+        verbose_name_plural = "Фасеты характеристик"
+        constraints = [models.UniqueConstraint(fields=['shop', 'category_id', 'parameter', 'value'],
+                                               name='unique_parameter_facet')]
+        indexes = [models.Index(fields=['category_id', 'shop'])]
+
+
 class Order(models.Model):
     user = models.ForeignKey(User, verbose_name="Заказчик", related_name="orders",
                              blank=True, on_delete=models.CASCADE)
@@ -206,6 +326,10 @@ class Order(models.Model):
                                 blank=True, null=True, on_delete=models.CASCADE)
     date_time = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=25, verbose_name="Статус заказа", choices=STATUS_CHOICES)
+    # итоги по позициям заказа, ведутся вместе с изменением позиций (backend/basket.py)
+    items_count = models.PositiveIntegerField(verbose_name="Количество позиций", default=0)
+    items_cost = models.PositiveBigIntegerField(verbose_name="Сумма по ценам", default=0)
+    items_cost_rrc = models.PositiveBigIntegerField(verbose_name="Сумма по рекомендуемым розничным ценам", default=0)
 
     class Meta:
         verbose_name = 'Заказ'
@@ -222,6 +346,9 @@ class OrderItem(models.Model):
                                 on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(verbose_name="Количество")
 
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['order', 'product_info'], name='unique_order_item')]
+
 
 class Contact(models.Model):
     user = models.ForeignKey(User, verbose_name="Покупатель", related_name="contacts", blank=True,
@@ -242,3 +369,37 @@ class Contact(models.Model):
     def __str__(self):
         return f'Город:{self.city}\nУлица:{self.street}\nДом:{self.house}\nТелефон:{self.phone}'
 
+
+class ImportJob(models.Model):
+    """Задача фонового импорта прайс-листа (выполняется командой manage.py import_worker)"""
+    user = models.ForeignKey(User, verbose_name="Поставщик", related_name="import_jobs",
+                             on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name="Магазин", related_name="import_jobs",
+                             blank=True, null=True, on_delete=models.SET_NULL)
+    url = models.URLField(verbose_name="Ссылка на прайс-лист")
+    state = models.CharField(max_length=15, verbose_name="Статус задачи", choices=IMPORT_STATE_CHOICES,
+                             default='queued')
+    processed = models.PositiveIntegerField(verbose_name="Обработано товаров", default=0)
+    created = models.PositiveIntegerField(verbose_name="Добавлено товаров", default=0)
+    updated = models.PositiveIntegerField(verbose_name="Обновлено товаров", default=0)
+    deleted = models.PositiveIntegerField(verbose_name="Удалено товаров", default=0)
+    error = models.TextField(verbose_name="Ошибка", blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Задача импорта'
+        verbose_name_plural = "Список задач импорта"
+        ordering = ('-created_at',)
+        indexes = [models.Index(fields=['state', 'id'])]
+
+    @property
+    def duration(self):
+        """Длительность выполнения задачи в секундах"""
+        if not self.started_at:
+            return None
+        return ((self.finished_at or timezone.now()) - self.started_at).total_seconds()
+
+    def __str__(self):
+        return f'import job {self.id}: {self.state}'
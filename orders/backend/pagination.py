@@ -0,0 +1,114 @@
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+"""Модуль постраничной выдачи каталога"""
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Постраничная выдача по курсору (keyset): следующая страница выбирается условием pk > <последний pk>
+    по индексу первичного ключа, поэтому дальние страницы стоят столько же, сколько первая.
+    При сортировке по нескольким полям (например, ('price', 'pk')) в курсор записываются значения всех полей
+    последней строки, а следующая страница выбирается условием (price, pk) > (<цена>, <pk>):
+    при равных значениях первого поля курсор не превращается в смещение (OFFSET).
+    Поля сортировки не должны допускать NULL, последнее поле должно быть уникальным.
+    Размер страницы задаётся параметром ?page_size= (по умолчанию PAGE_SIZE из настроек)
+    """
+    ordering = 'pk'
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    # разделитель значений полей сортировки в позиции курсора
+    position_separator = '~'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        offset, reverse, current_position = self.cursor or (0, False, None)
+
+        if reverse:
+            queryset = queryset.order_by(*(field[1:] if field.startswith('-') else f'-{field}'
+                                           for field in self.ordering))
+        else:
+            queryset = queryset.order_by(*self.ordering)
+        if current_position is not None:
+            queryset = queryset.filter(self._after_position(queryset.model, current_position, reverse))
+
+        # строка сверх страницы - признак следующей страницы
+        results = list(queryset[offset:offset + self.page_size + 1])
+        self.page = results[:self.page_size]
+        if len(results) > len(self.page):
+            has_following_position = True
+            following_position = self._get_position_from_instance(results[-1], self.ordering)
+        else:
+            has_following_position = False
+            following_position = None
+
+        if reverse:
+            # страница назад читалась в обратном порядке
+            self.page.reverse()
+            self.has_next = current_position is not None or offset > 0
+            self.has_previous = has_following_position
+            if self.has_next:
+                self.next_position = current_position
+            if self.has_previous:
+                self.previous_position = following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = current_position is not None or offset > 0
+            if self.has_next:
+                self.next_position = following_position
+            if self.has_previous:
+                self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def _after_position(self, model, position, reverse):
+        """
+        Условие "строка после позиции курсора" в порядке сортировки: для ('price', 'pk') -
+        price >= <цена> AND (price > <цена> OR (price = <цена> AND pk > <pk>)).
+        Первое условие задаёт начало диапазона индекса, остальные отбрасывают уже выданные строки
+        """
+        values = position.split(self.position_separator)
+        if len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        query, equal = Q(), {}
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            try:
+                value = (model._meta.pk if name == 'pk' else model._meta.get_field(name)).to_python(value)
+            except ValidationError:
+                raise NotFound(self.invalid_cursor_message)
+            # по убыванию (или при чтении назад) следующие строки - с меньшими значениями
+            lookup = 'lt' if field.startswith('-') != reverse else 'gt'
+            query |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        first = self.ordering[0].lstrip('-')
+        lookup = 'lte' if self.ordering[0].startswith('-') != reverse else 'gte'
+        return Q(**{f'{first}__{lookup}': equal[first]}) & query
+
+    def _get_position_from_instance(self, instance, ordering):
+        values = []
+        for field in ordering:
+            name = field.lstrip('-')
+            values.append(str(instance[name] if isinstance(instance, dict) else getattr(instance, name)))
+        return self.position_separator.join(values)
+
+
+class SearchPagination(PageNumberPagination):
+    """
+    Постраничная выдача результатов поиска (?page=, ?page_size=): результаты отсортированы по релевантности,
+    а не по ключу, поэтому курсор здесь не подходит
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
@@ -0,0 +1,127 @@
+import csv
+import io
+
+import yaml
+from ujson import dumps as dump_json
+
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
+from backend.models import Category, Parameter, ProductInfo, ProductParameter
+
+"""Модуль потоковой выгрузки (экспорта) товаров магазина"""
+# Выгрузка идёт в той же структуре, что и прайс для импорта (см. data/shop3.yaml),
+# поэтому выгруженный файл можно загрузить обратно через импорт.
+# Товары читаются курсором (.iterator()) пачками по CHUNK_SIZE, а ответ отдаётся частями
+# через StreamingHttpResponse - документ целиком в памяти не собирается.
+
+CHUNK_SIZE = 2000
+
+PRICE_EXPORTERS = {}
+
+
+def register_exporter(name, content_type, extension):
+    """Декоратор для регистрации функции выгрузки в формате name"""
+    def decorator(func):
+        PRICE_EXPORTERS[name] = (func, content_type, extension)
+        return func
+    return decorator
+
+
+def iter_goods(shop, chunk_size=CHUNK_SIZE):
+    """Товары магазина в формате раздела goods прайса. Характеристики запрашиваются одним запросом на пачку"""
+    queryset = ProductInfo.objects.filter(shop_id=shop.id).order_by('id').values_list(
+        'id', 'external_id', 'product__category_id', 'model', 'product__name', 'description',
+        'price', 'price_rrc', 'quantity')
+    rows = queryset.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = [row for _, row in zip(range(chunk_size), rows)]
+        if not chunk:
+            return
+        parameters = {}
+        for product_info_id, name, value in ProductParameter.objects.filter(
+                product_info_id__in=[row[0] for row in chunk]).order_by('id').values_list(
+                'product_info_id', 'parameter__name', 'value'):
+            parameters.setdefault(product_info_id, {})[name] = value
+        for product_info_id, external_id, category, model, name, description, price, price_rrc, quantity in chunk:
+            item = {'id': external_id if external_id is not None else product_info_id,
+                    'category': category,
+                    'model': model,
+                    'name': name,
+                    'price': price,
+                    'price_rrc': price_rrc,
+                    'quantity': quantity,
+                    'parameters': parameters.get(product_info_id, {})}
+            if description:
+                item['description'] = description
+            yield item
+
+
+def shop_categories(shop):
+    return [{'id': category_id, 'name': name}
+            for category_id, name in Category.objects.filter(shop=shop).order_by('id').values_list('id', 'name')]
+
+
+def _dump_yaml(data):
+    return yaml.dump(data, Dumper=SafeDumper, allow_unicode=True, sort_keys=False, default_flow_style=False)
+
+
+def _indent(text):
+    return ''.join(f'  {line}' for line in text.splitlines(keepends=True))
+
+
+@register_exporter('yaml', 'application/x-yaml; charset=utf-8', 'yaml')
+def export_yaml(shop):
+    yield _dump_yaml({'shop': shop.name})
+    yield 'categories:\n'
+    yield _indent(_dump_yaml(shop_categories(shop)))
+    yield 'goods:\n'
+    for item in iter_goods(shop):
+        yield _indent(_dump_yaml([item]))
+
+
+@register_exporter('json', 'application/json', 'json')
+def export_json(shop):
+    yield f'{{"shop":{dump_json(shop.name, ensure_ascii=False)},' \
+          f'"categories":{dump_json(shop_categories(shop), ensure_ascii=False)},"goods":['
+    separator = ''
+    for item in iter_goods(shop):
+        yield separator + dump_json(item, ensure_ascii=False)
+        separator = ','
+    yield ']}'
+
+
+@register_exporter('ndjson', 'application/x-ndjson', 'ndjson')
+def export_ndjson(shop):
+    yield dump_json({'shop': shop.name, 'categories': shop_categories(shop)}, ensure_ascii=False) + '\n'
+    for item in iter_goods(shop):
+        yield dump_json(item, ensure_ascii=False) + '\n'
+
+
+@register_exporter('csv', 'text/csv; charset=utf-8', 'csv')
+def export_csv(shop):
+    """CSV в формате импорта: характеристики - колонки "param:<имя>" (см. price_parsers.load_price_csv)"""
+    categories = {category['id']: category['name'] for category in shop_categories(shop)}
+    parameters = list(Parameter.objects.filter(products_parameters__product_info__shop_id=shop.id)
+                      .order_by('name').values_list('name', flat=True).distinct())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    writer.writerow(['shop', 'category', 'category_name', 'id', 'name', 'model', 'description',
+                     'price', 'price_rrc', 'quantity'] + [f'param:{name}' for name in parameters])
+    for number, item in enumerate(iter_goods(shop), start=1):
+        writer.writerow([shop.name, item['category'], categories.get(item['category'], ''), item['id'],
+                         item['name'], item['model'] or '', item.get('description', ''), item['price'],
+                         item['price_rrc'], item['quantity']] +
+                        [item['parameters'].get(name, '') for name in parameters])
+        if number % 100 == 0:
+            yield flush()
+    yield flush()
@@ -0,0 +1,235 @@
+import codecs
+import csv
+import posixpath
+from urllib.parse import urlparse
+
+import yaml
+from ujson import loads as load_json
+
+try:
+    # C-версия загрузчика (libyaml) в разы быстрее, используем её если PyYAML собран с libyaml
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+"""Модуль разбора прайс-листов поставщиков (YAML, JSON, NDJSON, CSV)"""
+# Каждый парсер принимает бинарный файл и возвращает словарь с ключами shop, categories и goods,
+# где goods может быть генератором. Формат выбирается по Content-Type ответа или расширению файла.
+# YAML, NDJSON и CSV разбираются потоково, без загрузки файла в память целиком.
+
+PRICE_PARSERS = {}
+CONTENT_TYPES = {}
+EXTENSIONS = {}
+DEFAULT_FORMAT = 'yaml'
+
+# колонки CSV, остальные колонки вида "param:<имя>" - характеристики товара
+CSV_PARAMETER_PREFIX = 'param:'
+CSV_INT_COLUMNS = ('id', 'category', 'price', 'price_rrc', 'quantity')
+
+
+class PriceFormatError(ValueError):
+    """Ошибка структуры прайс-листа"""
+
+
+def register_parser(name, content_types=(), extensions=()):
+    """Декоратор для регистрации парсера формата прайса"""
+    def decorator(func):
+        PRICE_PARSERS[name] = func
+        CONTENT_TYPES.update(dict.fromkeys(content_types, name))
+        EXTENSIONS.update(dict.fromkeys(extensions, name))
+        return func
+    return decorator
+
+
+def get_price_parser(content_type=None, url=None):
+    """Выбор парсера: по Content-Type, если он однозначный, иначе по расширению файла, иначе YAML"""
+    if content_type:
+        name = CONTENT_TYPES.get(content_type.split(';')[0].strip().lower())
+        if name:
+            return PRICE_PARSERS[name]
+    if url:
+        name = EXTENSIONS.get(posixpath.splitext(urlparse(url).path)[1].lower())
+        if name:
+            return PRICE_PARSERS[name]
+    return PRICE_PARSERS[DEFAULT_FORMAT]
+
+
+def _check_header(data):
+    if not isinstance(data, dict) or not {'shop', 'categories'}.issubset(data):
+        raise PriceFormatError('Не указаны разделы shop и categories')
+    return data
+
+
+def _compose_node(loader, anchors):
+    """Собирает узел YAML из событий парсера (аналог Composer.compose_node, есть и у C-загрузчика)"""
+    event = loader.get_event()
+    if isinstance(event, yaml.AliasEvent):
+        return anchors[event.anchor]
+    if isinstance(event, yaml.ScalarEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+        node = yaml.ScalarNode(tag, event.value, event.start_mark, event.end_mark, style=event.style)
+    elif isinstance(event, yaml.SequenceStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.SequenceNode, None, event.implicit)
+        node = yaml.SequenceNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        while not loader.check_event(yaml.SequenceEndEvent):
+            node.value.append(_compose_node(loader, anchors))
+        node.end_mark = loader.get_event().end_mark
+    elif isinstance(event, yaml.MappingStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(yaml.MappingNode, None, event.implicit)
+        node = yaml.MappingNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _compose_node(loader, anchors)
+            node.value.append((key, _compose_node(loader, anchors)))
+        node.end_mark = loader.get_event().end_mark
+    else:
+        raise PriceFormatError(f'Неожиданное событие YAML: {event}')
+    if getattr(event, 'anchor', None):
+        anchors[event.anchor] = node
+    return node
+
+
+def _construct(loader, node):
+    data = loader.construct_object(node, deep=True)
+    # сбрасываем кэш построенных объектов, иначе он будет расти вместе с файлом
+    loader.constructed_objects = {}
+    loader.recursive_objects = {}
+    return data
+
+
+def _iter_goods(loader, anchors):
+    try:
+        while not loader.check_event(yaml.SequenceEndEvent):
+            yield _construct(loader, _compose_node(loader, anchors))
+    finally:
+        loader.dispose()
+
+
+@register_parser('yaml', content_types=('application/x-yaml', 'application/yaml', 'text/yaml', 'text/x-yaml'),
+                 extensions=('.yaml', '.yml'))
+def load_price_yaml(stream):
+    """
+    Потоковый разбор прайса в формате YAML (см. data/shop3.yaml).
+    Возвращает словарь с ключами shop, categories и goods, где goods - генератор товаров
+    """
+    loader = SafeLoader(stream)
+    anchors = {}
+    data = {}
+    try:
+        for event_class in (yaml.StreamStartEvent, yaml.DocumentStartEvent, yaml.MappingStartEvent):
+            if not loader.check_event(event_class):
+                raise PriceFormatError('Прайс-лист должен быть словарём с ключами shop, categories и goods')
+            loader.get_event()
+
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _construct(loader, _compose_node(loader, anchors))
+            if key == 'goods':
+                if not {'shop', 'categories'}.issubset(data):
+                    raise PriceFormatError('Разделы shop и categories должны идти в прайсе перед goods')
+                if not loader.check_event(yaml.SequenceStartEvent):
+                    raise PriceFormatError('Раздел goods должен быть списком')
+                loader.get_event()
+                data['goods'] = _iter_goods(loader, anchors)
+                return data
+            data[key] = _construct(loader, _compose_node(loader, anchors))
+    except Exception:
+        loader.dispose()
+        raise
+    loader.dispose()
+    _check_header(data)
+    data['goods'] = iter(())
+    return data
+
+
+@register_parser('json', content_types=('application/json',), extensions=('.json',))
+def load_price_json(stream):
+    """Прайс в формате JSON с той же структурой, что и YAML. Файл разбирается целиком (ujson)"""
+    try:
+        data = load_json(stream.read())
+    except ValueError as error:
+        raise PriceFormatError(f'Ошибка разбора JSON: {error}') from error
+    _check_header(data)
+    data.setdefault('goods', [])
+    return data
+
+
+def _iter_ndjson_goods(lines):
+    for number, line in enumerate(lines, start=2):
+        if line.strip():
+            try:
+                yield load_json(line)
+            except ValueError as error:
+                raise PriceFormatError(f'Ошибка разбора NDJSON в строке {number}: {error}') from error
+
+
+@register_parser('ndjson', content_types=('application/x-ndjson', 'application/ndjson', 'application/jsonl',
+                                          'application/x-jsonlines'),
+                 extensions=('.ndjson', '.jsonl'))
+def load_price_ndjson(stream):
+    """
+    Прайс в формате NDJSON (по одному JSON-объекту в строке):
+    первая строка - {"shop": ..., "categories": [...]}, каждая следующая - товар из goods
+    """
+    lines = iter(stream)
+    try:
+        data = load_json(next(lines, b'') or b'null')
+    except ValueError as error:
+        raise PriceFormatError(f'Ошибка разбора NDJSON в строке 1: {error}') from error
+    _check_header(data)
+    data['goods'] = _iter_ndjson_goods(lines)
+    return data
+
+
+def _read_csv(stream):
+    stream.seek(0)
+    return csv.DictReader(codecs.iterdecode(stream, 'utf-8-sig'))
+
+
+def _csv_item(row):
+    item = {'parameters': {}}
+    for column, value in row.items():
+        if column is None or value is None:
+            raise PriceFormatError(f'Количество значений в строке не совпадает с заголовком: {row}')
+        if column.startswith(CSV_PARAMETER_PREFIX):
+            if value != '':
+                item['parameters'][column[len(CSV_PARAMETER_PREFIX):]] = value
+        elif column in CSV_INT_COLUMNS:
+            try:
+                item[column] = int(value)
+            except ValueError as error:
+                raise PriceFormatError(f'Значение колонки {column} должно быть числом: {value}') from error
+        elif column not in ('shop', 'category_name'):
+            item[column] = value or None
+    return item
+
+
+def _iter_csv_goods(stream):
+    for row in _read_csv(stream):
+        yield _csv_item(row)
+
+
+@register_parser('csv', content_types=('text/csv', 'application/csv'), extensions=('.csv',))
+def load_price_csv(stream):
+    """
+    Прайс в формате CSV (UTF-8, разделитель - запятая), одна строка - один товар.
+    Колонки: shop, category, category_name, id, name, model, description, price, price_rrc, quantity,
+    характеристики - колонки "param:<имя параметра>" (пустое значение - характеристики нет).
+    Файл читается в два прохода: сначала магазин и категории, затем товары
+    """
+    shop, categories = None, {}
+    try:
+        for row in _read_csv(stream):
+            shop = shop or row.get('shop')
+            categories.setdefault(int(row['category']), row.get('category_name') or row['category'])
+    except (KeyError, ValueError, csv.Error) as error:
+        raise PriceFormatError(f'Ошибка разбора CSV: {error}') from error
+    if not shop:
+        raise PriceFormatError('В CSV не указана колонка shop')
+    return {'shop': shop,
+            'categories': [{'id': category_id, 'name': name} for category_id, name in categories.items()],
+            'goods': _iter_csv_goods(stream)}
@@ -0,0 +1,92 @@
+import re
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import FloatField, Q
+from django.db.models.expressions import RawSQL
+
+from backend.models import CatalogItem
+
+"""Модуль полнотекстового поиска по каталогу"""
+# Поиск идёт по модели чтения CatalogItem (название продукта, модель, описание), которая обновляется
+# при импорте прайса, поэтому отдельно поддерживать поисковый индекс не нужно:
+# - PostgreSQL: GIN-индекс по выражению to_tsvector(...), ранжирование ts_rank;
+# - SQLite (локальный запуск): внешняя FTS5-таблица, синхронизируемая триггерами, ранжирование bm25;
+# - прочие СУБД: поиск подстроки без ранжирования.
+# Индекс создаётся после migrate (см. сигнал post_migrate в backend/signals.py).
+
+SEARCH_CONFIG = getattr(settings, 'SEARCH_CONFIG', 'russian')
+
+TABLE = CatalogItem._meta.db_table
+FTS_TABLE = f'{TABLE}_fts'
+PK_COLUMN = CatalogItem._meta.pk.column
+
+# выражение должно совпадать в индексе и в запросе, иначе PostgreSQL не использует индекс
+PG_VECTOR = (f"to_tsvector('{SEARCH_CONFIG}', coalesce(product_name, '') || ' ' || coalesce(model, '') "
+             f"|| ' ' || coalesce(description, ''))")
+
+PG_INDEX = f'CREATE INDEX IF NOT EXISTS {TABLE}_search ON {TABLE} USING gin ({PG_VECTOR})'
+
+SQLITE_INDEX = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(product_name, model, description, "
+    f"content='{TABLE}', content_rowid='{PK_COLUMN}', tokenize='unicode61')",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_insert AFTER INSERT ON {TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, product_name, model, description) "
+    f"VALUES (new.{PK_COLUMN}, new.product_name, new.model, new.description); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_delete AFTER DELETE ON {TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, product_name, model, description) "
+    f"VALUES ('delete', old.{PK_COLUMN}, old.product_name, old.model, old.description); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_update AFTER UPDATE ON {TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, product_name, model, description) "
+    f"VALUES ('delete', old.{PK_COLUMN}, old.product_name, old.model, old.description); "
+    f"INSERT INTO {FTS_TABLE}(rowid, product_name, model, description) "
+    f"VALUES (new.{PK_COLUMN}, new.product_name, new.model, new.description); END",
+    # заполняем индекс строками, добавленными до его создания
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')",
+]
+
+
+def ensure_search_index(using='default'):
+    """Создаёт поисковый индекс каталога, если его ещё нет"""
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(PG_INDEX)
+        elif connection.vendor == 'sqlite':
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [FTS_TABLE])
+            if cursor.fetchone() is None:
+                for statement in SQLITE_INDEX:
+                    cursor.execute(statement)
+
+
+def _fts5_query(text):
+    """Строка запроса FTS5: каждое слово - префикс, слова объединяются через И (спецсимволы отбрасываются)"""
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text))
+
+
+def search_catalog(text, queryset=None, using='default'):
+    """
+    Товары каталога, подходящие под запрос text, с аннотацией rank (чем больше, тем выше в выдаче),
+    отсортированные по релевантности
+    """
+    if queryset is None:
+        queryset = CatalogItem.objects.all()
+    vendor = connections[using].vendor
+    if vendor == 'postgresql':
+        query = f"websearch_to_tsquery('{SEARCH_CONFIG}', %s)"
+        queryset = queryset.extra(where=[f'{PG_VECTOR} @@ {query}'], params=[text]) \
+            .annotate(rank=RawSQL(f'ts_rank({PG_VECTOR}, {query})', [text], output_field=FloatField()))
+    elif vendor == 'sqlite':
+        query = _fts5_query(text)
+        if not query:
+            return queryset.none()
+        # FTS5-таблица присоединяется по rowid; bm25 отрицательный - чем меньше, тем релевантнее
+        queryset = queryset.extra(tables=[FTS_TABLE],
+                                  where=[f'{FTS_TABLE}.rowid = {TABLE}.{PK_COLUMN}', f'{FTS_TABLE} MATCH %s'],
+                                  params=[query], select={'rank': f'-bm25({FTS_TABLE})'})
+    else:
+        condition = Q()
+        for word in text.split():
+            condition &= Q(product_name__icontains=word) | Q(model__icontains=word) | Q(description__icontains=word)
+        queryset = queryset.filter(condition).annotate(rank=RawSQL('0', [], output_field=FloatField()))
+    return queryset.order_by('-rank', 'pk')
@@ -1,7 +1,86 @@
 from django.db.models import Sum, F
 from rest_framework import serializers, validators
 
-from backend.models import Shop, Category, Product, User, Contact, ProductParameter, ProductInfo, Order, OrderItem
+from backend.models import Shop, Category, Product, User, Contact, ProductParameter, ProductInfo, Order, OrderItem, \
+    ImportJob, CatalogItem
+
+
+def fieldset_from_request(request):
+    """
+    Параметры выбора полей ответа из запроса:
+    ?fields=id,price,ordered_items.quantity - только перечисленные поля (вложенные - через точку);
+    ?expand=shop,product_parameters - раскрываемые связанные объекты, остальные отдаются как id или не отдаются.
+    Если параметр не передан, ответ полный, как раньше
+    """
+    fieldset = {'fields': None, 'expand': None}
+    for param in fieldset:
+        if param in request.GET:
+            fieldset[param] = {name.strip() for name in request.GET[param].split(',') if name.strip()}
+    return fieldset
+
+
+def _split_fields(fields):
+    top = {}
+    for path in fields:
+        name, _, rest = path.partition('.')
+        top.setdefault(name, set())
+        if rest:
+            top[name].add(rest)
+    return top
+
+
+def fieldset_includes(fieldset, path, expandable=False):
+    """
+    Попадёт ли в ответ поле path (через точку, например ordered_items.product_info.shop).
+    expandable - поле отдаётся целиком только при ?expand=
+    """
+    if expandable and fieldset['expand'] is not None and path.rsplit('.', 1)[-1] not in fieldset['expand']:
+        return False
+    fields, parts = fieldset['fields'], path.split('.')
+    while fields and parts:
+        top = _split_fields(fields)
+        if parts[0] not in top:
+            return False
+        fields, parts = top[parts[0]], parts[1:]
+    return True
+
+
+def apply_fieldset(serializer, fields=None, expand=None):
+    """Убирает из сериализатора (и вложенных в него) невыбранные поля и сворачивает нераскрытые связи"""
+    if isinstance(serializer, serializers.ListSerializer):
+        serializer = serializer.child
+    if expand is not None:
+        for name, collapsed in getattr(serializer, 'expandable_fields', {}).items():
+            if name not in expand and name in serializer.fields:
+                if collapsed is None:
+                    del serializer.fields[name]
+                else:
+                    serializer.fields[name] = collapsed()
+    top = _split_fields(fields) if fields else None
+    if top is not None:
+        for name in list(serializer.fields):
+            if name not in top:
+                del serializer.fields[name]
+    for name, field in serializer.fields.items():
+        if isinstance(field, serializers.BaseSerializer):
+            apply_fieldset(field, top[name] if top else None, expand)
+
+
+class DynamicFieldsMixin:
+    """
+    Сериализатор с выбором полей: принимает fields и expand (см. fieldset_from_request).
+    expandable_fields - связи, которые отдаются целиком только при ?expand=:
+    имя поля -> фабрика поля для свёрнутого вида (None - поле не отдаётся)
+    """
+    expandable_fields = {}
+
+    def __init__(self, *args, fields=None, expand=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        apply_fieldset(self, fields, expand)
+
+
+def _related_id():
+    return serializers.PrimaryKeyRelatedField(read_only=True)
 
 
 class ShopSerializer(serializers.ModelSerializer):
@@ -37,6 +116,30 @@ class ProductInfoSerializer(serializers.ModelSerializer):
         fields = ('id', 'shop', 'model', 'product', 'description', 'quantity', 'price_rrc', 'product_parameters',)
         read_only_fields = ('id',)
 
+class CatalogItemSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    """Строка модели чтения каталога в том же виде, что и ProductInfoSerializer"""
+    expandable_fields = {'shop': lambda: serializers.IntegerField(source='shop_id', read_only=True),
+                         'product': lambda: serializers.IntegerField(source='product_id', read_only=True),
+                         'product_parameters': None}
+
+    id = serializers.IntegerField(source='product_info_id', read_only=True)
+    shop = serializers.SerializerMethodField()
+    product = serializers.SerializerMethodField()
+    product_parameters = serializers.JSONField(source='parameters', read_only=True)
+
+    class Meta:
+        model = CatalogItem
+        fields = ('id', 'shop', 'model', 'product', 'description', 'quantity', 'price_rrc', 'product_parameters',)
+        read_only_fields = fields
+
+    def get_shop(self, obj):
+        return {'id': obj.shop_id, 'name': obj.shop_name, 'url': obj.shop_url, 'address': obj.shop_address,
+                'state': obj.shop_state}
+
+    def get_product(self, obj):
+        return {'id': obj.product_id, 'name': obj.product_name, 'category': obj.category_id}
+
+
 class ContactSerializer(serializers.ModelSerializer):
     # Сюда потом можно добавить валидацию номера телефона, и номеров дома, кв и т.п.
     class Meta:
@@ -69,7 +172,14 @@ class OrderItemSerializer(serializers.ModelSerializer):
         #     'order': {'write_only': True}
         # }
 
-class ProductInfoShopSerializer(serializers.ModelSerializer):
+class BasketItemSerializer(serializers.Serializer):
+    """Позиция, добавляемая в корзину; наличие товаров проверяется одним запросом на всю корзину"""
+    product_info = serializers.IntegerField(min_value=1)
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class ProductInfoShopSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+    expandable_fields = {'shop': _related_id, 'product': _related_id, 'product_parameters': None}
     product = ProductSerializer(read_only=True)
     shop = ShopSerializer(read_only=True)
     product_parameters = ProductParameterSerializer(read_only=True, many=True)
@@ -79,7 +189,7 @@ class ProductInfoShopSerializer(serializers.ModelSerializer):
         fields = ('id', 'product', 'shop', 'model', 'description', 'product_parameters')
 
 
-class OrderItemShopSerializer(OrderItemSerializer):
+class OrderItemShopSerializer(DynamicFieldsMixin, OrderItemSerializer):
     product_info = ProductInfoShopSerializer(read_only=True)
 
     class Meta:
@@ -88,7 +198,7 @@ class OrderItemShopSerializer(OrderItemSerializer):
         read_only_fields = ('id',)
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     ordered_items = OrderItemShopSerializer(read_only=True, many=True)
     total_cost = serializers.IntegerField()    # при загрузке через annotate обязательно заявить тип данных
     class Meta:
@@ -97,7 +207,7 @@ class OrderSerializer(serializers.ModelSerializer):
         read_only_fields = ('id',)
 
 
-class OrderPartnerSerializer(serializers.ModelSerializer):
+class OrderPartnerSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     product_info = ProductInfoShopSerializer(read_only=True)
     order_item_cost = serializers.IntegerField()
     contact = serializers.CharField(source='order.contact', allow_null=True)
@@ -105,4 +215,14 @@ class OrderPartnerSerializer(serializers.ModelSerializer):
     class Meta:
         model = OrderItem
         fields = ('order', 'product_info', 'quantity', 'order_item_cost', 'contact')
-        read_only_fields = ('id',)
\ No newline at end of file
+        read_only_fields = ('id',)
+
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    duration = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = ImportJob
+        fields = ('id', 'url', 'shop', 'state', 'processed', 'created', 'updated', 'deleted', 'error',
+                  'created_at', 'started_at', 'finished_at', 'duration')
+        read_only_fields = fields
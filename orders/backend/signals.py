@@ -1,9 +1,15 @@
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_migrate, post_save, pre_save
 from django.dispatch import receiver, Signal
+from django.utils import timezone
 from django_rest_passwordreset.signals import reset_password_token_created
 
-from backend.models import ConfirmEmailToken, User
+from backend.cache import bump_catalog_version
+from backend.catalog import rebuild_facets, record_changes, refresh_catalog_items, sync_shop
+from backend.search import ensure_search_index
+from backend.models import ConfirmEmailToken, User, Shop, Category, Product, Parameter, ProductParameter, CatalogItem
 
 """Модуль для отправки уведомлений на почту"""
 # использует штатный Framework «диспетчер сигналов»
@@ -79,3 +85,87 @@ def new_order_signal(user_id, **kwargs):
         [user.email]
     )
     msg.send()
+
+
+@receiver(pre_save, sender=Shop)
+def shop_changing_signal(instance, raw=False, update_fields=None, **kwargs):
+    """
+    При изменении магазина (в т.ч. статуса приёма заказов) меняем версию его каталога,
+    чтобы закэшированные ответы каталога перестали использоваться.
+    Версия увеличивается выражением F() в самом UPDATE, иначе save() записал бы устаревшее значение из объекта
+    """
+    if not raw and not instance._state.adding and (update_fields is None or 'catalog_version' in update_fields):
+        instance.catalog_version = F('catalog_version') + 1
+        instance.catalog_updated_at = timezone.now()
+
+
+@receiver(post_save, sender=Shop)
+def shop_changed_signal(instance, created=False, raw=False, update_fields=None, **kwargs):
+    """
+    Переносим данные магазина в модель чтения каталога.
+    Сохранение только части полей (update_fields) версию в UPDATE не включает - увеличиваем её отдельно
+    """
+    if raw or created:
+        return
+    sync_shop(instance)
+    if update_fields is not None and 'catalog_version' not in update_fields:
+        bump_catalog_version(instance.id)
+    # в объекте осталось выражение F() вместо версии (или устаревшая версия) - перечитываем её из базы
+    instance.refresh_from_db(fields=['catalog_version', 'catalog_updated_at'])
+
+
+@receiver(m2m_changed, sender=Category.shop.through)
+def category_shops_changed_signal(instance, action, reverse=False, pk_set=None, **kwargs):
+    """Изменение магазинов категории меняет версию списка категорий (Category.updated_at)"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        categories = Category.objects.filter(id__in=pk_set) if pk_set is not None else Category.objects.all()
+    else:
+        categories = Category.objects.filter(id=instance.id)
+    categories.update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Product)
+def product_changed_signal(instance, created=False, raw=False, **kwargs):
+    """
+    Изменение продукта (например, через админку) переносим в модель чтения каталога,
+    при смене категории пересчитываем фасеты магазинов
+    """
+    if raw or created:
+        return
+    items = {}
+    for product_info_id, shop_id in CatalogItem.objects.filter(product_id=instance.id).values_list('pk', 'shop_id'):
+        items.setdefault(shop_id, []).append(product_info_id)
+    moved = CatalogItem.objects.filter(product_id=instance.id).exclude(category_id=instance.category_id).exists()
+    CatalogItem.objects.filter(product_id=instance.id).update(product_name=instance.name,
+                                                              category_id=instance.category_id)
+    for shop_id, product_info_ids in items.items():
+        if moved:
+            rebuild_facets(shop_id)
+        record_changes(shop_id, 'updated', product_info_ids)
+        bump_catalog_version(shop_id)
+
+
+@receiver(post_save, sender=Parameter)
+def parameter_changed_signal(instance, created=False, raw=False, **kwargs):
+    """При переименовании параметра пересобираем строки каталога товаров с этим параметром"""
+    if raw or created:
+        return
+    product_info_ids = list(ProductParameter.objects.filter(parameter_id=instance.id)
+                            .values_list('product_info_id', flat=True).distinct())
+    refresh_catalog_items(product_info_ids)
+    items = {}
+    for product_info_id, shop_id in CatalogItem.objects.filter(product_info_id__in=product_info_ids) \
+            .values_list('pk', 'shop_id'):
+        items.setdefault(shop_id, []).append(product_info_id)
+    for shop_id, shop_product_info_ids in items.items():
+        record_changes(shop_id, 'updated', shop_product_info_ids)
+        bump_catalog_version(shop_id)
+
+
+@receiver(post_migrate)
+def create_search_index_signal(sender, using='default', **kwargs):
+    """После миграций приложения создаём поисковый индекс каталога (см. backend/search.py)"""
+    if sender.name == 'backend':
+        ensure_search_index(using)
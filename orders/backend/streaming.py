@@ -0,0 +1,56 @@
+from django.db.models import prefetch_related_objects
+from django.http import StreamingHttpResponse
+from ujson import dumps
+
+from backend.fast_serializers import CHUNK_SIZE, chunks
+
+"""Модуль потоковой выдачи больших списков в JSON"""
+# Строки кодируются по мере чтения из БД и отдаются клиенту пачками через StreamingHttpResponse,
+# поэтому время до первого байта и расход памяти не зависят от размера выборки.
+# Включается параметром запроса ?stream=true (см. ProductView, PartnerOrder, OrderView).
+
+ROWS_PER_CHUNK = 500
+
+
+def stream_requested(request):
+    return request.GET.get('stream', '').lower() in ('1', 'true', 'yes')
+
+
+def dump_json(data):
+    return dumps(data, ensure_ascii=False, escape_forward_slashes=False)
+
+
+def iter_json_list(rows, prefix='[', suffix=']', rows_per_chunk=ROWS_PER_CHUNK):
+    """
+    Части JSON-документа со списком rows между prefix и suffix.
+    suffix может быть функцией: она вызывается после выдачи всех строк (например, для итоговой суммы)
+    """
+    yield prefix
+    buffer = []
+    separator = ''
+    for row in rows:
+        buffer.append(separator + dump_json(row))
+        separator = ','
+        if len(buffer) >= rows_per_chunk:
+            yield ''.join(buffer)
+            buffer = []
+    yield ''.join(buffer)
+    yield suffix() if callable(suffix) else suffix
+
+
+def iter_serialized(queryset, serializer_class, prefetch=(), chunk_size=CHUNK_SIZE, **kwargs):
+    """
+    Строки queryset через сериализатор DRF, пачками по chunk_size (для запросов с ?fields= и ?expand=).
+    iterator() не выполняет prefetch_related, поэтому связи prefetch загружаются на каждую пачку
+    """
+    for chunk in chunks(queryset.iterator(chunk_size=chunk_size), chunk_size):
+        prefetch_related_objects(chunk, *prefetch)
+        yield from serializer_class(chunk, many=True, **kwargs).data
+
+
+class StreamingJSONResponse(StreamingHttpResponse):
+    """Ответ из частей JSON-документа (например, из iter_json_list)"""
+
+    def __init__(self, chunks, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__((chunk.encode() for chunk in chunks if chunk), **kwargs)
@@ -1,3 +1,498 @@
-from django.test import TestCase
+import threading
+import time
+from base64 import b64decode
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase
+
+from backend.autocomplete import AutocompleteIndex
+from backend.catalog import publish_changes
+from backend.fast_serializers import CATALOG_ITEM_VALUES, catalog_item_row
+from backend.importer import import_price, PriceImporter, ShopMismatchError
+from backend.models import User, ImportJob, Order, OrderItem, ProductInfo, ProductParameter, CatalogItem, Shop, \
+    Product, Parameter, Contact, Category, CatalogChange
+from backend.serializers import CatalogItemSerializer
+
+
+def create_user(email, type='buyer'):
+    return User.objects.create(email=email, username=email, type=type, is_active=True)
+
+
+def price(goods, shop='Связной'):
+    """Прайс-лист в виде словаря для import_price; goods - список (id, название, цена, количество)"""
+    return {'shop': shop,
+            'categories': [{'id': 224, 'name': 'Смартфоны'}],
+            'goods': [{'id': external_id, 'category': 224, 'model': f'model/{external_id}', 'name': name,
+                       'price': cost, 'price_rrc': cost + 1000, 'quantity': quantity,
+                       'parameters': {'Цвет': 'черный'}}
+                      for external_id, name, cost, quantity in goods]}
+
+
+class PriceReconciliationTests(TestCase):
+    """Повторный импорт прайса сверяется с сохранёнными предложениями по id товара поставщика"""
+
+    def setUp(self):
+        self.seller = create_user('seller@example.com', 'seller')
+        import_price(price([(1, 'Смартфон A', 1000, 10), (2, 'Смартфон B', 2000, 5)]), self.seller.id)
+        self.ids = dict(ProductInfo.objects.values_list('external_id', 'id'))
+
+    def test_unchanged_price_touches_nothing(self):
+        importer = import_price(price([(1, 'Смартфон A', 1000, 10), (2, 'Смартфон B', 2000, 5)]), self.seller.id)
+        self.assertEqual((importer.created, importer.updated, importer.deleted), (0, 0, 0))
+        self.assertEqual(dict(ProductInfo.objects.values_list('external_id', 'id')), self.ids)
+
+    def test_update_delete_and_create_by_external_id(self):
+        importer = import_price(price([(2, 'Смартфон B', 2500, 4), (3, 'Смартфон C', 3000, 1)]), self.seller.id)
+        self.assertEqual((importer.created, importer.updated, importer.deleted), (1, 1, 1))
+        offers = {row[0]: row[1:] for row in ProductInfo.objects.values_list('external_id', 'id', 'price', 'quantity')}
+        self.assertEqual(offers.keys(), {2, 3})
+        # изменившееся предложение обновлено на месте, а не пересоздано
+        self.assertEqual(offers[2], (self.ids[2], 2500, 4))
+        self.assertFalse(ProductParameter.objects.filter(product_info_id=self.ids[1]).exists())
+        self.assertEqual(CatalogItem.objects.get(pk=self.ids[2]).price, 2500)
+        self.assertFalse(CatalogItem.objects.filter(pk=self.ids[1]).exists())
+
+    def test_other_shop_untouched(self):
+        other = create_user('other@example.com', 'seller')
+        import_price(price([(1, 'Смартфон A', 900, 3)], shop='DNS'), other.id)
+        import_price(price([(2, 'Смартфон B', 2000, 5)]), self.seller.id)
+        self.assertEqual(ProductInfo.objects.get(shop__user=other, external_id=1).price, 900)
+
+
+class ReferenceDeduplicationTests(TestCase):
+    """Справочники продуктов и параметров общие для магазинов и не дублируются параллельными импортами"""
+
+    def test_interleaved_imports_share_references(self):
+        data = [price([(1, 'Same phone', 1000, 1)], shop=name) for name in ('Связной', 'DNS')]
+        for item in data:
+            item['goods'][0]['parameters'] = {'NewParam': 'да'}
+        importers = [PriceImporter(Shop.objects.create(name=name, user=create_user(f'{name}@example.com', 'seller')))
+                     for name in ('Связной', 'DNS')]
+        # оба импорта загрузили справочники до того, как любой из них добавил новые записи
+        for importer, item in zip(importers, data):
+            importer.import_categories(item['categories'])
+        for importer, item in zip(importers, data):
+            importer.import_goods(item['goods'])
+
+        self.assertEqual(Parameter.objects.filter(name='NewParam').count(), 1)
+        self.assertEqual(Product.objects.filter(name='Same phone').count(), 1)
+        self.assertEqual(len(set(ProductInfo.objects.values_list('product_id', flat=True))), 1)
+
+
+class FastSerializerTests(TestCase):
+    """Быстрая сериализация строк каталога совпадает с сериализатором DRF"""
+
+    def test_catalog_item_row(self):
+        seller = create_user('seller@example.com', 'seller')
+        data = price([(1, 'Смартфон A', 1000, 10), (2, 'Смартфон B', 2000, 0)])
+        data['goods'][1].update(model=None, description='Описание', parameters={})
+        import_price(data, seller.id)
+        Shop.objects.filter(user=seller).update(url='https://example.com/price.yaml')
+        CatalogItem.objects.update(shop_url='https://example.com/price.yaml')
+
+        items = CatalogItem.objects.order_by('pk')
+        fast = [catalog_item_row(row) for row in items.values(*CATALOG_ITEM_VALUES)]
+        slow = CatalogItemSerializer(items, many=True).data
+        self.assertEqual(JSONRenderer().render(fast), JSONRenderer().render(slow))
+
+
+class CatalogConditionalGetTests(APITestCase):
+    """Условные запросы к каталогу не должны получать 304 после изменений"""
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(create_user('buyer@example.com'))
+
+    def test_shop_list_after_shop_deleted(self):
+        shops = [Shop.objects.create(name=name, user=create_user(f'{name}@example.com', 'seller'), state=True)
+                 for name in ('Связной', 'DNS')]
+        response = self.client.get('/api/v1/shop')
+        self.assertNotIn('Last-Modified', response)
+        etag = response['ETag']
+        self.assertEqual(self.client.get('/api/v1/shop', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        shops[0].delete()
+        response = self.client.get('/api/v1/shop', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([shop['name'] for shop in response.json()['results']], ['DNS'])
+
+    def test_category_list_after_rename(self):
+        category = Category.objects.create(name='Смартфоны')
+        etag = self.client.get('/api/v1/category')['ETag']
+        self.assertEqual(self.client.get('/api/v1/category', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        category.name = 'Телефоны'
+        category.save()
+        response = self.client.get('/api/v1/category', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['name'] for item in response.json()['results']], ['Телефоны'])
+        # привязка категории к магазину тоже меняет список
+        etag = response['ETag']
+        category.shop.add(Shop.objects.create(name='DNS', user=create_user('dns@example.com', 'seller')))
+        self.assertEqual(self.client.get('/api/v1/category', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_shop_save_keeps_version_readable(self):
+        shop = Shop.objects.create(name='DNS', user=create_user('dns@example.com', 'seller'))
+        shop.state = False
+        shop.save()
+        self.assertEqual(shop.catalog_version, 2)
+        shop.save(update_fields=['state'])
+        self.assertEqual(shop.catalog_version, 3)
+
+
+class CatalogPaginationTests(APITestCase):
+    """Постраничная выдача каталога по курсору при сортировке по полю с равными значениями"""
+
+    def setUp(self):
+        cache.clear()
+        import_price(price([(external_id, f'Смартфон {external_id}', 1000, 0) for external_id in range(1, 31)]),
+                     create_user('seller@example.com', 'seller').id)
+        self.ids = sorted(CatalogItem.objects.values_list('pk', flat=True))
+        self.client.force_authenticate(create_user('buyer@example.com'))
+
+    def walk(self, url, link='next'):
+        """id товаров всех страниц по ссылкам link и токены курсоров этих ссылок"""
+        ids, tokens = [], []
+        while url:
+            response = self.client.get(url).json()
+            ids.extend(item['id'] for item in response['results'])
+            url = response[link]
+            if url:
+                cursor = parse_qs(urlparse(url).query)['cursor'][0]
+                tokens.append(parse_qs(b64decode(cursor).decode()))
+        return ids, tokens
+
+    def test_ties_paged_by_value_and_pk(self):
+        for ordering, expected in (('quantity', self.ids), ('-price', self.ids[::-1])):
+            for fields in ('', '&fields=id,price'):
+                ids, tokens = self.walk(f'/api/v1/product?ordering={ordering}&page_size=7{fields}')
+                self.assertEqual(ids, expected)
+                # курсор хранит позицию, а не смещение
+                self.assertTrue(all('o' not in token and 'p' in token for token in tokens))
+
+    def test_previous_pages(self):
+        response = self.client.get('/api/v1/product?ordering=quantity&page_size=7').json()
+        while response['next']:
+            response = self.client.get(response['next']).json()
+        ids, _ = self.walk(response['previous'], link='previous')
+        self.assertEqual(sorted(ids), self.ids[:28])
+
+    def test_invalid_params(self):
+        for params in ('shop_id=abc', 'category_id=1x', 'product_id=-1', 'cursor=cD14fjE%3D&ordering=price'):
+            self.assertIn(self.client.get(f'/api/v1/product?{params}').status_code, (400, 404), params)
+
+
+class CatalogChangesTests(APITestCase):
+    """Журнал изменений каталога: курсор since и постраничная выдача"""
+
+    def setUp(self):
+        cache.clear()
+        self.seller = create_user('seller@example.com', 'seller')
+        self.client.force_authenticate(create_user('buyer@example.com'))
+
+    def changes(self, since, limit=2):
+        return self.client.get('/api/v1/product/changes', {'since': since, 'limit': limit}).json()
+
+    def test_changes_since_cursor(self):
+        import_price(price([(1, 'Смартфон A', 1000, 10), (2, 'Смартфон B', 2000, 5)]), self.seller.id)
+        ids = dict(ProductInfo.objects.values_list('external_id', 'id'))
+        import_price(price([(2, 'Смартфон B', 2500, 5), (3, 'Смартфон C', 3000, 1)]), self.seller.id)
+        ids[3] = ProductInfo.objects.get(external_id=3).id
+
+        since, seen = 0, []
+        while True:
+            page = self.changes(since)
+            seen.extend((change['id'], change['action']) for change in page['Changes'])
+            since = page['Next']
+            if not page['HasMore']:
+                break
+        self.assertEqual(seen, [(ids[1], 'created'), (ids[2], 'created'), (ids[3], 'created'),
+                                (ids[2], 'updated'), (ids[1], 'deleted')])
+        self.assertEqual(self.changes(since)['Changes'], [])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/api/v1/product/changes', {'since': 'x'}).status_code, 400)
+
+    def test_seq_published_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            import_price(price([(1, 'Смартфон A', 1000, 10), (2, 'Смартфон B', 2000, 5)]), self.seller.id)
+        self.assertFalse(CatalogChange.objects.filter(seq__isnull=True).exists())
+        self.assertEqual(list(CatalogChange.objects.order_by('seq').values_list('id', flat=True)),
+                         list(CatalogChange.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_late_commit_gets_later_seq(self):
+        shop = Shop.objects.create(name='Связной', user=self.seller)
+        early, late = (CatalogChange.objects.create(shop=shop, product_info_id=product_info_id, action='created')
+                       for product_info_id in (1, 2))
+        # запись late опубликована, пока транзакция записи early (с меньшим id) ещё не была зафиксирована
+        CatalogChange.objects.filter(id=late.id).update(seq=100)
+        self.assertEqual(publish_changes(), 1)
+        early.refresh_from_db()
+        # клиент, уже получивший seq=100, увидит early следующей страницей
+        self.assertGreater(early.seq, 100)
+        self.assertEqual([change['id'] for change in self.changes(100)['Changes']], [1])
+        self.assertEqual(publish_changes(), 0)
+
+
+class AutocompleteTests(TestCase):
+    """Индекс автодополнения перестраивается вне запроса и только для изменившихся магазинов"""
+
+    def setUp(self):
+        self.sellers = [create_user(f'{name}@example.com', 'seller') for name in ('svyaznoy', 'dns')]
+        import_price(price([(1, 'Смартфон Apple iPhone', 1000, 1), (2, 'Смартфон Xiaomi', 900, 1)]),
+                     self.sellers[0].id)
+        import_price(price([(1, 'Смартфон Xiaomi', 950, 1)], shop='DNS'), self.sellers[1].id)
+        Shop.objects.update(state=True)
+        self.index = AutocompleteIndex(check_interval=3600)
+        self.index.refresh()
+
+    def test_lookup(self):
+        self.assertEqual(self.index.lookup('смар'), [{'value': 'Смартфон Xiaomi', 'count': 2},
+                                                     {'value': 'Смартфон Apple iPhone', 'count': 1}])
+        self.assertEqual(self.index.lookup('xi смар'), [{'value': 'Смартфон Xiaomi', 'count': 2}])
+        self.assertEqual(self.index.lookup('с', limit=1), [{'value': 'Смартфон Xiaomi', 'count': 2}])
+
+    def test_refresh_off_request_path(self):
+        import_price(price([(1, 'Смартфон Xiaomi', 950, 1), (2, 'Смартфон Samsung', 800, 1)], shop='DNS'),
+                     self.sellers[1].id)
+        shops = dict(self.index.index[0])
+        with mock.patch.object(self.index, 'schedule_refresh') as schedule_refresh:
+            # запрос отдаёт текущий индекс и только ставит проверку версий в фон
+            self.assertEqual(self.index.lookup('sams'), [])
+            schedule_refresh.assert_called_once()
+        self.index.refresh()
+        self.assertEqual(self.index.lookup('sams'), [{'value': 'Смартфон Samsung', 'count': 1}])
+        unchanged, changed = (Shop.objects.get(user=seller).id for seller in self.sellers)
+        self.assertIs(self.index.index[0][unchanged][1], shops[unchanged][1])
+        self.assertIsNot(self.index.index[0][changed][1], shops[changed][1])
+
+
+class ImportJobTests(APITestCase):
+    """Статус задач импорта поставщика"""
+
+    def setUp(self):
+        cache.clear()
+        self.seller = create_user('seller@example.com', 'seller')
+        self.client.force_authenticate(self.seller)
+
+    def test_job_list_without_job_id(self):
+        job = ImportJob.objects.create(user=self.seller, url='https://example.com/price.yaml')
+        ImportJob.objects.create(user=create_user('other@example.com', 'seller'), url='https://example.com/other.yaml')
+        response = self.client.get('/api/v1/partner/import')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['id'] for item in response.json()['Jobs']], [job.id])
+
+    def test_job_status(self):
+        job = ImportJob.objects.create(user=self.seller, url='https://example.com/price.yaml')
+        response = self.client.get(f'/api/v1/partner/import/{job.id}')
+        self.assertEqual(response.json()['Job']['id'], job.id)
+        self.assertEqual(self.client.get(f'/api/v1/partner/import/{job.id + 1}').status_code, 404)
+
+    def test_admin_import_into_selected_shop(self):
+        shop = Shop.objects.create(name='Связной', user=self.seller)
+        admin = create_user('admin@example.com', 'buyer')
+        User.objects.filter(id=admin.id).update(is_staff=True)
+        self.client.force_authenticate(User.objects.get(id=admin.id))
+        url = 'https://example.com/price.yaml'
+        response = self.client.post('/api/v1/admin/import', {'items': [{'shop': shop.id, 'url': url}]}, format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(ImportJob.objects.get(id=response.json()['Jobs'][0]).shop_id, shop.id)
+        response = self.client.post('/api/v1/admin/import', {'items': [{'shop': shop.id + 1, 'url': url}]},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_price_of_other_shop_rejected(self):
+        shop = Shop.objects.create(name='Связной', user=self.seller)
+        with self.assertRaises(ShopMismatchError):
+            import_price(price([(1, 'Смартфон A', 1000, 1)], shop='DNS'), self.seller.id, shop=shop)
+        self.assertEqual(list(Shop.objects.values_list('name', flat=True)), ['Связной'])
+        import_price(price([(1, 'Смартфон A', 1000, 1)]), self.seller.id, shop=shop)
+        self.assertEqual(ProductInfo.objects.get().shop_id, shop.id)
+
+
+class BasketTests(APITestCase):
+    """Добавление товаров в корзину пакетным INSERT ... ON CONFLICT"""
+
+    def setUp(self):
+        cache.clear()
+        import_price(price([(1, 'Смартфон A', 1000, 10), (2, 'Смартфон B', 2000, 10), (3, 'Смартфон C', 3000, 10)]),
+                     create_user('seller@example.com', 'seller').id)
+        self.products = list(ProductInfo.objects.order_by('external_id').values_list('id', flat=True))
+        self.buyer = create_user('buyer@example.com')
+        self.client.force_authenticate(self.buyer)
+
+    def add(self, *items):
+        return self.client.post('/api/v1/user/basket',
+                                {'items': [{'product_info': product_info, 'quantity': quantity}
+                                           for product_info, quantity in items]}, format='json').json()
+
+    def basket(self):
+        return dict(OrderItem.objects.filter(order__user=self.buyer, order__status='basket')
+                    .values_list('product_info_id', 'quantity'))
+
+    def test_add_and_update_counts(self):
+        first, second, third = self.products
+        response = self.add((first, 1), (second, 2))
+        self.assertEqual(response['Message'], 'В корзину добавлено товаров 2, обновлено 0')
+        response = self.add((second, 3), (third, 1), (third, 4))
+        self.assertEqual(response['Message'], 'В корзину добавлено товаров 1, обновлено 1')
+        self.assertEqual(self.basket(), {first: 1, second: 5, third: 5})
+
+    def test_totals_follow_lines(self):
+        first, second, _ = self.products
+        self.add((first, 2), (second, 1))
+        basket = Order.objects.get(user=self.buyer, status='basket')
+        self.assertEqual((basket.items_count, basket.items_cost, basket.items_cost_rrc), (2, 4000, 7000))
+        self.assertEqual(self.client.get('/api/v1/user/basket').json()[0]['total_cost'], 4000)
+
+    def test_other_orders_untouched(self):
+        first, _, _ = self.products
+        other = create_user('other@example.com')
+        OrderItem.objects.create(order=Order.objects.create(user=other, status='basket'), product_info_id=first,
+                                 quantity=7)
+        self.add((first, 1))
+        self.assertEqual(OrderItem.objects.get(order__user=other).quantity, 7)
+        self.assertEqual(self.basket(), {first: 1})
+
+    def test_invalid_batch_writes_nothing(self):
+        first, _, _ = self.products
+        response = self.add((first, 1), (10 ** 6, 1))
+        self.assertFalse(response['Status'])
+        response = self.add((first, 1), (first, 0))
+        self.assertFalse(response['Status'])
+        self.assertEqual(self.basket(), {})
+
+
+class StockReservationTests(APITestCase):
+    """Резервирование товаров при оформлении заказа и возврат при отмене"""
+
+    def setUp(self):
+        cache.clear()
+        import_price(price([(1, 'Смартфон A', 1000, 5), (2, 'Смартфон B', 2000, 3)]),
+                     create_user('seller@example.com', 'seller').id)
+        self.first, self.second = ProductInfo.objects.order_by('external_id').values_list('id', flat=True)
+        self.buyer = create_user('buyer@example.com')
+        self.contact = Contact.objects.create(user=self.buyer, city='Москва', street='Тверская', house='1',
+                                              phone='+70000000000')
+        self.client.force_authenticate(self.buyer)
+
+    def checkout(self, *items):
+        self.client.post('/api/v1/user/basket', {'items': [{'product_info': product_info, 'quantity': quantity}
+                                                           for product_info, quantity in items]}, format='json')
+        order = Order.objects.get(user=self.buyer, status='basket')
+        response = self.client.post('/api/v1/user/order', {'order_id': str(order.id),
+                                                           'contact_id': str(self.contact.id)})
+        return order.id, response.json()
+
+    def stock(self):
+        return (dict(ProductInfo.objects.values_list('id', 'quantity')),
+                dict(CatalogItem.objects.values_list('pk', 'quantity')))
+
+    def test_checkout_reserves_stock(self):
+        order_id, response = self.checkout((self.first, 2), (self.second, 3))
+        self.assertTrue(response['Status'])
+        self.assertEqual(Order.objects.get(id=order_id).status, 'new')
+        expected = {self.first: 3, self.second: 0}
+        self.assertEqual(self.stock(), (expected, expected))
+
+    def test_insufficient_stock_fails_whole_order(self):
+        order_id, response = self.checkout((self.first, 2), (self.second, 4))
+        self.assertFalse(response['Status'])
+        self.assertIn(str(self.second), response['Errors'])
+        self.assertEqual(Order.objects.get(id=order_id).status, 'basket')
+        expected = {self.first: 5, self.second: 3}
+        self.assertEqual(self.stock(), (expected, expected))
+
+    def test_cancel_restores_stock(self):
+        order_id, _ = self.checkout((self.first, 2), (self.second, 1))
+        response = self.client.delete('/api/v1/user/order', {'order_id': order_id}, format='json').json()
+        self.assertTrue(response['Status'])
+        self.assertEqual(Order.objects.get(id=order_id).status, 'canceled')
+        expected = {self.first: 5, self.second: 3}
+        self.assertEqual(self.stock(), (expected, expected))
+        # повторная отмена не возвращает остатки второй раз
+        response = self.client.delete('/api/v1/user/order', {'order_id': order_id}, format='json').json()
+        self.assertFalse(response['Status'])
+        self.assertEqual(self.stock(), (expected, expected))
+
+    def test_catalog_not_stale_after_checkout(self):
+        def quantity(response):
+            return {item['id']: item['quantity'] for item in response.json()['results']}[self.first]
+
+        shop_id = Shop.objects.get().id
+        responses = [self.client.get(url) for url in ('/api/v1/product', f'/api/v1/product?shop_id={shop_id}')]
+        self.assertEqual([quantity(response) for response in responses], [5, 5])
+        versions = list(Shop.objects.values_list('catalog_version', flat=True))
+        # версия каталога меняется после фиксации, при публикации записей журнала изменений
+        with self.captureOnCommitCallbacks(execute=True):
+            self.checkout((self.first, 2))
+        self.assertEqual(list(Shop.objects.values_list('catalog_version', flat=True)), versions)
+        # ни закэшированный ответ, ни 304 по старому ETag не должны отдавать остаток до резервирования
+        for response in responses:
+            url = response.wsgi_request.get_full_path()
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(quantity(response), 3)
+            self.assertEqual(quantity(self.client.get(url)), 3)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentCheckoutTests(TransactionTestCase):
+    """
+    Оформление заказов на разные товары не ждёт незафиксированного заказа другого покупателя
+    (ни в одном магазине, ни в разных). Нужна СУБД с блокировкой строк (PostgreSQL):
+    в SQLite пишущая транзакция блокирует всю базу, и тест пропускается
+    """
+    TIMEOUT = 10
+
+    def setUp(self):
+        import_price(price([(1, 'Смартфон A', 1000, 5), (2, 'Смартфон B', 2000, 5)]),
+                     create_user('seller@example.com', 'seller').id)
+        import_price(price([(1, 'Смартфон A', 900, 5)], shop='DNS'), create_user('dns@example.com', 'seller').id)
+        self.products = list(ProductInfo.objects.order_by('shop_id', 'external_id').values_list('id', flat=True))
+        self.orders = []
+        for number, product_info_id in enumerate(self.products):
+            buyer = create_user(f'buyer{number}@example.com')
+            order = Order.objects.create(user=buyer, status='basket')
+            OrderItem.objects.create(order=order, product_info_id=product_info_id, quantity=1)
+            contact = Contact.objects.create(user=buyer, city='Москва', street='Тверская', house='1',
+                                             phone='+70000000000')
+            self.orders.append((buyer.id, order.id, contact.id))
+
+    def test_checkouts_do_not_wait_for_open_checkout(self):
+        from backend import basket
+        started, release = threading.Event(), threading.Event()
+        sync_stock = basket._sync_stock
+        holder = []
+
+        def hold_transaction(stock):
+            # первый заказ держит транзакцию открытой после всех своих записей
+            sync_stock(stock)
+            if threading.current_thread() in holder:
+                started.set()
+                release.wait(self.TIMEOUT)
+
+        def first_checkout():
+            try:
+                basket.checkout_order(*self.orders[0])
+            finally:
+                connection.close()
+
+        with mock.patch.object(basket, '_sync_stock', hold_transaction):
+            thread = threading.Thread(target=first_checkout)
+            holder.append(thread)
+            thread.start()
+            self.assertTrue(started.wait(self.TIMEOUT))
+            try:
+                # другой товар того же магазина и товар другого магазина
+                for order in self.orders[1:]:
+                    began = time.monotonic()
+                    self.assertTrue(basket.checkout_order(*order))
+                    self.assertLess(time.monotonic() - began, 1)
+            finally:
+                release.set()
+                thread.join()
+        self.assertEqual(set(Order.objects.values_list('status', flat=True)), {'new'})
@@ -5,33 +5,46 @@ from django.contrib.auth.password_validation import validate_password
 from django.db import IntegrityError
 
 from django.http import JsonResponse
-from requests import get
-from django.http import HttpRequest, JsonResponse
+from django.http import HttpRequest, JsonResponse, StreamingHttpResponse
 from rest_framework.authtoken.models import Token
 from rest_framework.generics import ListAPIView
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from yaml import load as load_yaml, Loader
 from ujson import loads as load_json
 from django.core.validators import URLValidator
 from django.core.exceptions import ValidationError
 from django.db.models import Q, Sum, F
+from backend.autocomplete import autocomplete_index, AUTOCOMPLETE_MAX_LIMIT
+from backend.basket import add_basket_items, update_basket_items, remove_basket_items, checkout_order, \
+    cancel_order, OutOfStock
+from backend.cache import catalog_cache, category_version
+from backend.catalog import facet_counts, parameter_filters, publish_changes
 from backend.decorators import query_debugger
-
-from backend.models import Shop, ProductInfo, Product, Parameter, ProductParameter, Category, Order, OrderItem, Contact
-from backend.serializers import ProductSerializer, ShopSerializer, UserSerializer, ProductInfoSerializer, \
-    OrderItemSerializer, OrderSerializer, OrderPartnerSerializer, ContactSerializer, CategorySerializer
+from backend.fast_serializers import CATALOG_ITEM_VALUES, catalog_item_row, serialize_orders, iter_catalog_items, \
+    iter_orders, iter_partner_items
+from backend.pagination import KeysetPagination, SearchPagination
+from backend.price_exporters import PRICE_EXPORTERS
+from backend.search import search_catalog
+from backend.streaming import StreamingJSONResponse, iter_json_list, iter_serialized, stream_requested
+
+from backend.models import Shop, ProductInfo, Product, Category, Order, OrderItem, Contact, ImportJob, CatalogItem, \
+    CatalogChange
+from backend.serializers import ProductSerializer, ShopSerializer, UserSerializer, OrderSerializer, \
+    OrderPartnerSerializer, ContactSerializer, CategorySerializer, ImportJobSerializer, CatalogItemSerializer, \
+    BasketItemSerializer, fieldset_from_request, fieldset_includes
 from backend.models import ConfirmEmailToken
 from backend.signals import new_user_registered, new_order
 
 
 class ShopView(APIView):
 
+    @catalog_cache()
     def get(self, request, *args, **kwargs):
-        """Просмотр всех магазинов"""
-        queryset = Shop.objects.all()
-        serializer = ShopSerializer(queryset, many=True)
-        return Response(serializer.data)
+        """Просмотр всех магазинов (постранично, по курсору)"""
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(Shop.objects.all(), request, view=self)
+        serializer = ShopSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
 
     # def post(self, request, *args, **kwargs):
     #     """Добавление нового магазина"""
@@ -55,19 +68,61 @@ class CategoryView(ListAPIView):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
 
+    @catalog_cache(extra_version=category_version)
+    def get(self, request, *args, **kwargs):
+        return self.list(request, *args, **kwargs)
+
+
+def related_prefetch(fieldset, path):
+    """
+    Связи товара (ProductInfo) по пути path, которые нужно загрузить для ответа с учётом ?fields= и ?expand=:
+    нераскрытые и невыбранные связи не загружаются
+    """
+    prefetch = []
+    parts = path.split('.')
+    for depth in range(1, len(parts) + 1):
+        if not fieldset_includes(fieldset, '.'.join(parts[:depth])):
+            return prefetch
+        prefetch.append('__'.join(parts[:depth]))
+    prefix = prefetch[-1]
+    for relation, lookup in (('product', 'product'), ('shop', 'shop'),
+                             ('product_parameters', 'product_parameters__parameter')):
+        if fieldset_includes(fieldset, f'{path}.{relation}', expandable=True):
+            prefetch.append(f'{prefix}__{lookup}')
+    return prefetch
+
+
+# количество последних задач импорта в ответе ImportPrice.get без job_id
+IMPORT_JOBS_LIMIT = 20
+
+# наибольшее количество товаров в одном запросе ProductBatch
+BATCH_LOOKUP_LIMIT = 5000
+
+# размер страницы журнала изменений каталога (ProductChanges)
+CHANGES_PAGE_SIZE = 1000
+CHANGES_MAX_PAGE_SIZE = 10000
+
+# поля, по которым можно сортировать каталог (?ordering=)
+CATALOG_ORDERING = ('price', 'price_rrc', 'quantity')
+
+
 class ProductView(APIView):
     """ Класс для просмотра товаров """
+    @catalog_cache(shop_param='shop_id', stock=True)
     @query_debugger
     def get(self, request, *args, **kwargs):
         # Присваиваем переменным параметры
         product_id = request.GET.get('product_id')
         shop_id = request.GET.get('shop_id')
         category_id = request.GET.get('category_id')
-        query_st = Q(shop__state=True)
+        for param, value in (('product_id', product_id), ('shop_id', shop_id), ('category_id', category_id)):
+            if value and not value.isdigit():
+                return JsonResponse({'Status': False, 'Error': f'Параметр {param} должен быть числом'}, status=400)
+        query_st = Q(shop_state=True)
 
         # Поиск по категории везде или с учётом магазина
         if category_id:  # Если параметр не None
-            query = query_st & Q(product__category_id=category_id)
+            query = query_st & Q(category_id=category_id)
             if shop_id:
                 query = query & Q(shop_id=shop_id)
 
@@ -83,20 +138,60 @@ class ProductView(APIView):
 
         # Выгрузка списка всех товаров
         else:
-            queryset = ProductInfo.objects.all().select_related().prefetch_related(
-                'product_parameters__parameter')
-            serializer = ProductInfoSerializer(queryset, many=True)
-            return Response(serializer.data)
-
-        queryset = ProductInfo.objects.filter(query). \
-            select_related('shop', 'product__category').prefetch_related(
-            'product_parameters__parameter')
-        # select_related позволяет осуществить только один запрос (сокращает время)
-        # Обеспечивает пересылку ForeignKey, OneToOne и обратный OneToOne.
-        # Для обработки связи ManyToMany и обратных ManyToMany, ForeignKey использовать prefetch_related
-        # для устранения дубликатов можно применить .distinct() например по модели .distinct('model')
-        serializer = ProductInfoSerializer(queryset, many=True)
-        return Response(serializer.data)
+            query = query_st
+
+        # Фильтры по характеристикам: ?param.Цвет=Серый&param.Встроенная память (Гб)=256
+        query = query & parameter_filters(request.GET)
+
+        # Диапазон цены и наличие: ?price_min=, ?price_max=, ?in_stock=true
+        for param, lookup in (('price_min', 'price__gte'), ('price_max', 'price__lte')):
+            value = request.GET.get(param)
+            if value:
+                if not value.isdigit():
+                    return JsonResponse({'Status': False, 'Error': f'Параметр {param} должен быть числом'},
+                                        status=400)
+                query = query & Q(**{lookup: int(value)})
+        if request.GET.get('in_stock', '').lower() in ('1', 'true', 'yes'):
+            query = query & Q(quantity__gt=0)
+
+        # Сортировка: ?ordering=price, -price, price_rrc, -price_rrc, quantity, -quantity
+        ordering = request.GET.get('ordering')
+        if ordering and ordering.lstrip('-') not in CATALOG_ORDERING:
+            return JsonResponse({'Status': False,
+                                 'Error': f'Сортировка возможна по полям: {", ".join(CATALOG_ORDERING)}'},
+                                status=400)
+
+        # Каталог читается из плоской модели CatalogItem (данные магазина, продукта и характеристики
+        # уже лежат в строке), поэтому страница - это один запрос по индексу без join и prefetch_related
+        queryset = CatalogItem.objects.filter(query)
+        # выбор полей ответа: ?fields=id,price_rrc,quantity, ?expand=shop,product_parameters
+        fieldset = fieldset_from_request(request)
+        if not fieldset_includes(fieldset, 'product_parameters', expandable=True):
+            queryset = queryset.defer('parameters')
+
+        # ?stream=true - вся выборка одним потоковым JSON-списком, без постраничной выдачи
+        if stream_requested(request):
+            queryset = queryset.order_by(*((ordering, '-pk' if ordering.startswith('-') else 'pk')
+                                           if ordering else ('pk',)))
+            if fieldset['fields'] is None and fieldset['expand'] is None:
+                rows = iter_catalog_items(queryset)
+            else:
+                rows = iter_serialized(queryset, CatalogItemSerializer, **fieldset)
+            return StreamingJSONResponse(iter_json_list(rows))
+
+        # Выдача постранично по курсору (?cursor=, ?page_size=), см. backend/pagination.py
+        paginator = KeysetPagination()
+        if ordering:
+            # в курсор записываются значение поля сортировки и pk последней строки, следующая страница -
+            # условие (поле, pk) > (значение, pk), без смещения при равных значениях (см. KeysetPagination)
+            paginator.ordering = (ordering, '-pk' if ordering.startswith('-') else 'pk')
+        if fieldset['fields'] is None and fieldset['expand'] is None:
+            # полный ответ собирается из строк .values() без сериализатора на каждую строку
+            page = paginator.paginate_queryset(queryset.values(*CATALOG_ITEM_VALUES), request, view=self)
+            return paginator.get_paginated_response([catalog_item_row(row) for row in page])
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = CatalogItemSerializer(page, many=True, **fieldset)
+        return paginator.get_paginated_response(serializer.data)
 
     def post(self, request, *args, **kwargs):
         """Добавление новых продуктов"""
@@ -125,9 +220,160 @@ class ProductView(APIView):
                                  'Error': f'Ошибка. Такой продукт уже существует с id {res.id} укажите другое название'},
                                 status=405)
 
+
+class ProductBatch(APIView):
+    """
+    Класс для получения многих предложений каталога одним запросом (например, для переоценки корзин в ERP).
+    Тело запроса: {"ids": [id ProductInfo, ...]} или {"shop": id магазина, "goods": [id товара из прайса, ...]}.
+    Ответ - товары в виде ProductInfoSerializer в порядке запроса (в т.ч. товары магазинов, не принимающих
+    заказы, см. shop.state) и список ненайденных id (Missing)
+    """
+    def post(self, request, *args, **kwargs):
+        ids, goods, shop_id = request.data.get('ids'), request.data.get('goods'), request.data.get('shop')
+        keys = ids if ids is not None else goods
+        if keys is None or (goods is not None and ids is not None):
+            return JsonResponse({'Status': False, 'Errors': 'Необходимо передать либо ids, либо shop и goods'},
+                                status=400)
+        if not isinstance(keys, list) or not all(type(key) == int for key in keys):
+            return JsonResponse({'Status': False, 'Errors': 'Идентификаторы необходимо передавать списком чисел'},
+                                status=400)
+        if len(keys) > BATCH_LOOKUP_LIMIT:
+            return JsonResponse({'Status': False,
+                                 'Errors': f'За один запрос можно получить не более {BATCH_LOOKUP_LIMIT} товаров'},
+                                status=400)
+
+        # один запрос к модели чтения каталога по первичному ключу или по (магазин, id товара поставщика)
+        if ids is not None:
+            key_field = 'pk'
+            queryset = CatalogItem.objects.filter(pk__in=keys).values(*CATALOG_ITEM_VALUES)
+        else:
+            if type(shop_id) != int:
+                return JsonResponse({'Status': False, 'Errors': 'Для поиска по goods необходимо указать shop'},
+                                    status=400)
+            key_field = 'product_info__external_id'
+            queryset = CatalogItem.objects.filter(shop_id=shop_id, product_info__external_id__in=keys) \
+                .values(*CATALOG_ITEM_VALUES, key_field)
+        rows = {row[key_field]: catalog_item_row(row) for row in queryset}
+        return Response({'Status': True,
+                         'Results': [rows[key] for key in dict.fromkeys(keys) if key in rows],
+                         'Missing': [key for key in dict.fromkeys(keys) if key not in rows]})
+
+
+class ProductChanges(APIView):
+    """
+    Класс для синхронизации копий каталога: изменения предложений после курсора ?since= (seq последнего
+    полученного изменения, для первой синхронизации - 0), не более ?limit= за запрос, можно ограничить ?shop_id=.
+    Для добавленных и изменённых товаров в item отдаётся их текущее состояние (как в ProductInfoSerializer),
+    для удалённых или удалённых позже - null. Следующую страницу запрашивают с since=Next, пока HasMore
+    """
+    def get(self, request, *args, **kwargs):
+        since, limit, shop_id = (request.GET.get(param, default) for param, default in
+                                 (('since', '0'), ('limit', str(CHANGES_PAGE_SIZE)), ('shop_id', None)))
+        if not since.isdigit() or not limit.isdigit() or (shop_id is not None and not shop_id.isdigit()):
+            return JsonResponse({'Status': False, 'Error': 'Параметры since, limit и shop_id должны быть числами'},
+                                status=400)
+        limit = min(max(int(limit), 1), CHANGES_MAX_PAGE_SIZE)
+
+        # записи получают seq после фиксации и становятся видны строго в порядке seq (см. publish_changes),
+        # поэтому курсор ничего не пропускает; публикуем записи, которые не опубликовались после фиксации
+        publish_changes()
+        changes = CatalogChange.objects.filter(seq__gt=int(since))
+        if shop_id is not None:
+            changes = changes.filter(shop_id=int(shop_id))
+        changes = list(changes.order_by('seq').values('seq', 'shop_id', 'product_info_id', 'action')[:limit + 1])
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+
+        items = {row['pk']: catalog_item_row(row) for row in CatalogItem.objects.filter(
+            pk__in={change['product_info_id'] for change in changes if change['action'] != 'deleted'})
+            .values(*CATALOG_ITEM_VALUES)}
+        return Response({'Status': True,
+                         'Changes': [{'seq': change['seq'], 'id': change['product_info_id'],
+                                      'shop': change['shop_id'], 'action': change['action'],
+                                      'item': items.get(change['product_info_id'])
+                                      if change['action'] != 'deleted' else None}
+                                     for change in changes],
+                         'Next': changes[-1]['seq'] if changes else int(since),
+                         'HasMore': has_more})
+
+
+class ProductSearch(APIView):
+    """
+    Класс для полнотекстового поиска товаров по названию, модели и описанию (?q=),
+    результаты отсортированы по релевантности. Можно ограничить поиск ?shop_id= и ?category_id=
+    """
+    @catalog_cache(shop_param='shop_id', stock=True)
+    @query_debugger
+    def get(self, request, *args, **kwargs):
+        text = request.GET.get('q', '').strip()
+        if not text:
+            return JsonResponse({'Status': False, 'Error': 'Не указана строка поиска q'}, status=400)
+        query = Q(shop_state=True)
+        if request.GET.get('shop_id'):
+            query = query & Q(shop_id=request.GET['shop_id'])
+        if request.GET.get('category_id'):
+            query = query & Q(category_id=request.GET['category_id'])
+
+        queryset = search_catalog(text, CatalogItem.objects.filter(query))
+        fieldset = fieldset_from_request(request)
+        if not fieldset_includes(fieldset, 'product_parameters', expandable=True):
+            queryset = queryset.defer('parameters')
+        paginator = SearchPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = CatalogItemSerializer(page, many=True, **fieldset)
+        return paginator.get_paginated_response(serializer.data)
+
+
+class ProductAutocomplete(APIView):
+    """
+    Класс для подсказок при вводе названия товара (?q=, ?limit=): названия продуктов и модели,
+    в которых есть слова, начинающиеся с введённых. Ищет по индексу в памяти, без запросов к БД
+    """
+    def get(self, request, *args, **kwargs):
+        limit = request.GET.get('limit', '10')
+        if not limit.isdigit() or not 0 < int(limit) <= AUTOCOMPLETE_MAX_LIMIT:
+            return JsonResponse({'Status': False,
+                                 'Error': f'Параметр limit должен быть числом от 1 до {AUTOCOMPLETE_MAX_LIMIT}'},
+                                status=400)
+        return Response({'Status': True,
+                         'Results': autocomplete_index.lookup(request.GET.get('q', ''), int(limit))})
+
+
+class ProductFacets(APIView):
+    """
+    Класс для получения фасетов каталога: количество товаров по значениям характеристик
+    с учётом фильтров ?shop_id=, ?category_id= и ?param.<имя>=<значение>
+    """
+    @catalog_cache(shop_param='shop_id')
+    def get(self, request, *args, **kwargs):
+        shop_id = request.GET.get('shop_id')
+        category_id = request.GET.get('category_id')
+        for value in (shop_id, category_id):
+            if value and not value.isdigit():
+                return JsonResponse({'Status': False, 'Error': 'Параметры shop_id и category_id должны быть числами'},
+                                    status=400)
+        return Response({'Status': True,
+                         'Facets': facet_counts(shop_id, category_id, parameter_filters(request.GET))})
+
 class ImportPrice(APIView):
-    # pass
-    """Загрузка (импорт) списка продуктов"""
+    """
+    Загрузка (импорт) списка продуктов.
+    Импорт выполняется в фоне воркером (manage.py import_worker), view только ставит задачу в очередь
+    """
+
+    def get(self, request, job_id=None, *args, **kwargs):
+        """Статус задачи импорта, без job_id - последние задачи импорта пользователя"""
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': '403',
+                                 'Error': 'Ошибка аутентификации пользователя'},
+                                status=403)
+        if job_id is None:
+            jobs = ImportJob.objects.filter(user_id=request.user.id)[:IMPORT_JOBS_LIMIT]
+            return JsonResponse({'Status': True, 'Jobs': ImportJobSerializer(jobs, many=True).data})
+        job = ImportJob.objects.filter(id=job_id, user_id=request.user.id).first()
+        if job is None:
+            return JsonResponse({'Status': False, 'Error': f'Задача импорта {job_id} не найдена'}, status=404)
+        return JsonResponse({'Status': True, 'Job': ImportJobSerializer(job).data})
 
     def post(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
@@ -148,38 +394,84 @@ class ImportPrice(APIView):
             except ValidationError as error:
                 return JsonResponse({'Status': False, 'Error': str(error)})
             else:
-                stream = get(url).content  # забираем данные в формате bytes
-                data = load_yaml(stream, Loader=Loader)  # загружаем через yaml и получаем данные в формате dict
-
-                # далее распарсим данные из словаря и загружаем из в базу
-                shop, _ = Shop.objects.get_or_create(name=data['shop'], user_id=request.user.id)
-                for category in data['categories']:
-                    # добавляем если ещё не существуют категории
-                    category_object, _ = Category.objects.get_or_create(id=category['id'], name=category['name'])
-                    category_object.shops.add(shop.id)  # отдельно добавляем id магазина
-                    category_object.save()
-                # отчищаем старые данные о товарах по этому магазину
-                ProductInfo.objects.filter(shop_id=shop.id).delete()
-                for item in data['goods']:
-                    product, _ = Product.objects.get_or_create(name=item['name'], category_id=item['category'])
-                    # Так как данные старые мы удалили, создаём заново из нашего нового прайса
-                    product_info = ProductInfo.objects.create(product_id=product.id,
-                                                              model=item['model'],
-                                                              price=item['price'],
-                                                              price_rrc=item['price_rrc'],
-                                                              quantity=item['quantity'],
-                                                              shop_id=shop.id)
-                    for name, value in item['parameters'].items():
-                        parameter_object, _ = Parameter.objects.get_or_create(name=name)
-                        ProductParameter.objects.create(product_info_id=product_info.id,
-                                                        parameter_id=parameter_object.id,
-                                                        value=value)
-
-                return JsonResponse({'Status': True})
+                job = ImportJob.objects.create(user_id=request.user.id, url=url)
+                return JsonResponse({'Status': True, 'Job': job.id, 'State': job.state}, status=202)
 
         return JsonResponse({'Status': False, 'Errors': 'Не указана ссылка на прайс-лист'})
 
 
+class ExportPrice(APIView):
+    """
+    Экспорт (выгрузка) товаров магазина в формате прайса: ?file_format=yaml|json|ndjson|csv.
+    Поставщик выгружает свой магазин, покупатель - любой работающий магазин по ?shop_id=
+    """
+
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Ошибка аутентификации'}, status=403)
+
+        export_format = request.GET.get('file_format', 'yaml')
+        if export_format not in PRICE_EXPORTERS:
+            return JsonResponse({'Status': False,
+                                 'Error': f'Формат выгрузки должен быть одним из: {", ".join(PRICE_EXPORTERS)}'})
+        shop_id = request.GET.get('shop_id')
+        if shop_id:
+            if not shop_id.isdigit():
+                return JsonResponse({'Status': False, 'Error': 'shop_id должен быть числом'})
+            shop = Shop.objects.filter(Q(state=True) | Q(user_id=request.user.id), id=shop_id).first()
+        else:
+            shop = Shop.objects.filter(user_id=request.user.id).first()
+        if shop is None:
+            return JsonResponse({'Status': False, 'Error': 'Магазин не найден'}, status=404)
+
+        export, content_type, extension = PRICE_EXPORTERS[export_format]
+        response = StreamingHttpResponse(export(shop), content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="shop-{shop.id}.{extension}"'
+        return response
+
+
+class AdminImport(APIView):
+    """
+    Массовый импорт прайсов нескольких магазинов (только для администраторов).
+    Задачи выполняются воркерами: manage.py import_worker --processes N
+    """
+
+    def get(self, request, *args, **kwargs):
+        """Статусы задач импорта: ?jobs=1,2,3"""
+        if not request.user.is_authenticated or not request.user.is_staff:
+            return JsonResponse({'Status': False, 'Error': 'Доступ разрешён только администраторам'}, status=403)
+        job_ids = [job_id for job_id in request.GET.get('jobs', '').split(',') if job_id.isdigit()]
+        jobs = ImportJob.objects.filter(id__in=job_ids).order_by('id')
+        return JsonResponse({'Status': True, 'Jobs': ImportJobSerializer(jobs, many=True).data})
+
+    def post(self, request, *args, **kwargs):
+        """Постановка в очередь импорта для списка пар {"shop": id магазина, "url": ссылка на прайс}"""
+        if not request.user.is_authenticated or not request.user.is_staff:
+            return JsonResponse({'Status': False, 'Error': 'Доступ разрешён только администраторам'}, status=403)
+
+        items = request.data.get('items')
+        if type(items) != list or not all(type(item) == dict and {'shop', 'url'}.issubset(item) for item in items):
+            return JsonResponse({'Status': False, 'Errors': 'Аргументы необходимо передавать в значении ключа "items" '
+                                                            'в виде списка {"shop": id, "url": ссылка}'}, status=400)
+        shops = dict(Shop.objects.filter(id__in=[item['shop'] for item in items if type(item['shop']) == int],
+                                         user__isnull=False).values_list('id', 'user_id'))
+        validate_url = URLValidator()
+        jobs = []
+        for item in items:
+            if item['shop'] not in shops:
+                return JsonResponse({'Status': False, 'Error': f'Магазин {item["shop"]} не найден'}, status=400)
+            try:
+                validate_url(item['url'])
+            except ValidationError as error:
+                return JsonResponse({'Status': False, 'Error': f'{item["url"]}: {error.messages[0]}'}, status=400)
+            # прайс загружается именно в выбранный магазин: если в прайсе указан другой магазин,
+            # задача завершится ошибкой (см. ShopMismatchError)
+            jobs.append(ImportJob(user_id=shops[item['shop']], shop_id=item['shop'], url=item['url']))
+
+        jobs = [ImportJob.objects.create(user_id=job.user_id, shop_id=job.shop_id, url=job.url) for job in jobs]
+        return JsonResponse({'Status': True, 'Jobs': [job.id for job in jobs]}, status=202)
+
+
 class LoginUser(APIView):
     """Вход пользователей. Аутентификация."""
 
@@ -301,58 +593,49 @@ class Basket(APIView):
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Ошибка аутентификации'}, status=403)
 
+        fieldset = fieldset_from_request(request)
         basket = Order.objects.filter(
             user_id=request.user.id, status='basket').prefetch_related(
-            'ordered_items__product_info__product', 'ordered_items__product_info__shop',
-            'ordered_items__product_info__product_parameters__parameter').annotate(
-            total_cost=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price'))).distinct()
+            *related_prefetch(fieldset, 'ordered_items.product_info')).annotate(total_cost=F('items_cost'))
 
-        serializer = OrderSerializer(basket, many=True)
+        if fieldset['fields'] is None and fieldset['expand'] is None:
+            return Response(serialize_orders(basket))
+        serializer = OrderSerializer(basket, many=True, **fieldset)
         return Response(serializer.data)
 
-    def post(selfself, request, *args, **kwargs):
+    def post(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Ошибка аутентификации'}, status=403)
 
         items = request.data.get('items')
 
         if type(items) == list:
+            if not all(isinstance(item, dict) and {'product_info', 'quantity'}.issubset(item) for item in items):
+                return JsonResponse({'Status': False,
+                                     'Errors': "Не указаны все необходимые аргументы "
+                                               "Пример:('product_info': value, 'quantity': value)"
+                                     })
+            # вся корзина проверяется и записывается пачкой, повторы одного товара складываются
+            serializer = BasketItemSerializer(data=items, many=True)
+            if not serializer.is_valid():
+                return JsonResponse({'Status': False, 'Errors': serializer.errors})
+            quantities = {}
+            for item in serializer.validated_data:
+                quantities[item['product_info']] = quantities.get(item['product_info'], 0) + item['quantity']
+            prices = {product_info_id: (price, price_rrc) for product_info_id, price, price_rrc in
+                      ProductInfo.objects.filter(id__in=quantities).values_list('id', 'price', 'price_rrc')}
+            missing = quantities.keys() - prices.keys()
+            if missing:
+                return JsonResponse({'Status': False,
+                                     'Errors': f'Товары не найдены: {", ".join(map(str, sorted(missing)))}'})
+
             basket, _ = Order.objects.get_or_create(user_id=request.user.id, status='basket')
             # в переменную _ записывается параметр сигнализирующий было ли создание,
             # True - Создалась запись в БД, False - запись существует
-
-            # Проработка модуля на проверку наличие в заказе product_info с таким ID
-            ordered_items = OrderItem.objects.filter(order=basket.id)
-            existing_objects = OrderItemSerializer(ordered_items, many=True)
-            created_index = 0
-            update_index = 0
-            for item in items:
-                if {'product_info', 'quantity'}.issubset(item):
-                    # добавляем ключ (order) и ID заказа (order.id) в словарь
-                    item.update({'order': basket.id})
-                    update_object = False
-                    for order_item in existing_objects.data:
-                        if order_item['product_info'] == item['product_info']:
-                            OrderItem.objects.filter(product_info=item['product_info']). \
-                                update(quantity=item['quantity'] + order_item['quantity'])
-                            update_object = True
-
-
-                    serializer = OrderItemSerializer(data=item)
-                    if serializer.is_valid() and update_object is not True:
-                        try:
-                            serializer.save()
-                        except IntegrityError as error:
-                            return JsonResponse({'Status': False, 'Errors': str(error)})
-                        else:
-                            created_index += 1
-                    else:
-                        return JsonResponse({'Status': False, 'Errors': serializer.errors})
-                else:
-                    return JsonResponse({'Status': False,
-                                         'Errors': "Не указаны все необходимые аргументы "
-                                                   "Пример:('product_info': value, 'quantity': value)"
-                                         })
+            try:
+                created_index, update_index = add_basket_items(basket.id, quantities, prices)
+            except IntegrityError as error:
+                return JsonResponse({'Status': False, 'Errors': str(error)})
             return JsonResponse({'Status': True, 'Message': f'В корзину добавлено товаров {created_index}, '
                                                             f'обновлено {update_index}'})
         else:
@@ -365,19 +648,17 @@ class Basket(APIView):
         items = request.data['items']
         if type(items) == list:
             basket, _ = Order.objects.get_or_create(user_id=request.user.id, status='basket')
-            objects_updated = 0
+            quantities = {}
             for item in items:
-
-                if type(item['id']) == int and type(item['quantity']) == int:
-                    objects_updated += OrderItem.objects.filter(id=item['id']).update(quantity=item['quantity'])
-                    return JsonResponse({'Status': True, 'Message': f'Обновлено позиций: {objects_updated}'})
-                    # тут не совсем честный отчёт по количеству обновлённых позиций,
-                    # запрос update выдаёт в ответ на запрос кол-во найденных элементов,
-                    # не учитывая совпало текущее значение переданное в update() с новым значением
+                if type(item.get('id')) == int and type(item.get('quantity')) == int and item['quantity'] > 0:
+                    quantities[item['id']] = item['quantity']
                 else:
                     return JsonResponse({'Status': False,
                                          'Errors': 'Должны быть переданы аргументы номера позиции (id)'
                                                    'и количества единиц товара (quantity) обязательно типа int'})
+            # обновляются только позиции этой корзины, итог корзины меняется в той же транзакции
+            objects_updated = update_basket_items(basket.id, quantities)
+            return JsonResponse({'Status': True, 'Message': f'Обновлено позиций: {objects_updated}'})
         else:
             return JsonResponse({'Status': False, 'Errors': 'Аргументы необходимо передавать в значении ключа "items" '
                                                             'в виде списка'})
@@ -389,18 +670,12 @@ class Basket(APIView):
         if type(items) == list:
             basket, _ = Order.objects.get_or_create(user_id=request.user.id,
                                                     status='basket')
-            deleted_items = 0
             for item_id in items:
                 if type(item_id) != int:  # проверяем что аргумент типа int
                     return JsonResponse({'Status': False,
                                          'Errors': 'ID удаляемого объекта должен передаваться типа int'})
-                # Индекс [0] позволяет присвоить переменной deleted_items кол-во удалённых объектов
-                deleted_items += OrderItem.objects.filter(order_id=basket.id, id=item_id).delete()[0]
-                print(deleted_items)
+            deleted_items = remove_basket_items(basket.id, items)
             return JsonResponse({'Status': True, 'Message': f'Из корзины удалено товаров {deleted_items}'})
-
-
-
         else:
             return JsonResponse({'Status': False, 'Errors': 'Удаляемые объекты необходимо передавать,'
                                                             ' как значение ключа items в виде списке'})
@@ -487,25 +762,33 @@ class PartnerOrder(APIView):
             return JsonResponse({'Status': False,
                                  'Error': 'Ошибка аутентификации - доступ разрешён только партнёрам'}, status=403)
 
+        fieldset = fieldset_from_request(request)
+        order_item = OrderItem.objects.filter(product_info__shop__user_id=request.user.id) \
+            .exclude(order__status='basket').prefetch_related(*related_prefetch(fieldset, 'product_info')) \
+            .annotate(order_item_cost=F('quantity') * F('product_info__price_rrc')).distinct()
         if order_id:
-            order_item = OrderItem.objects.filter(product_info__shop__user_id=request.user.id, order__id=order_id) \
-                .exclude(order__status='basket').prefetch_related(
-                'product_info__product_parameters__parameter', 'product_info__shop',
-                'product_info__product', ).select_related('order__contact') \
-                .annotate(order_item_cost=F('quantity') * F('product_info__price_rrc')).distinct()
+            order_item = order_item.filter(order__id=order_id)
+        if fieldset_includes(fieldset, 'contact'):
+            order_item = order_item.select_related('order__contact')
 
-        else:
-            order_item = OrderItem.objects.filter(product_info__shop__user_id=request.user.id) \
-                .exclude(order__status='basket').prefetch_related(
-                'product_info__product_parameters__parameter', 'product_info__shop',
-                'product_info__product', ).select_related('order__contact') \
-                .annotate(order_item_cost=F('quantity') * F('product_info__price_rrc')).distinct()
+        if stream_requested(request):
+            if fieldset['fields'] is None and fieldset['expand'] is None:
+                rows = iter_partner_items(order_item)
+            else:
+                rows = iter_serialized(order_item, OrderPartnerSerializer,
+                                       prefetch=related_prefetch(fieldset, 'product_info'), **fieldset)
+
+            def total_sum():
+                # итоговая сумма считается запросом в конце выдачи, список в памяти не собирается
+                total = order_item.aggregate(total=Sum('order_item_cost'))['total'] or 0
+                return f'],"total_sum":{total}}}'
+            return StreamingJSONResponse(iter_json_list(rows, prefix='{"orders":[', suffix=total_sum))
 
         if order_item:
-            serializer = OrderPartnerSerializer(order_item, many=True)
+            serializer = OrderPartnerSerializer(order_item, many=True, **fieldset)
             total_sum = 0
-            for data in serializer.data:
-                total_sum += data['order_item_cost']
+            for item in order_item:
+                total_sum += item.order_item_cost
             return JsonResponse({'orders': serializer.data, 'total_sum': total_sum})
         else:
             return Response('Заказов по магазину нет')
@@ -518,23 +801,25 @@ class OrderView(APIView):
     def get(self, request, order_id=None, *args, **kwargs):
         if not request.user.is_authenticated:
             return JsonResponse({'Status': False, 'Error': 'Ошибка аутентификации'}, status=403)
+        fieldset = fieldset_from_request(request)
+        order = Order.objects.filter(user__id=request.user.id). \
+            exclude(status='basket').prefetch_related(*related_prefetch(fieldset, 'ordered_items.product_info')
+        ).annotate(total_cost=F('items_cost_rrc'))
         if order_id:
-            order = Order.objects.filter(user__id=request.user.id, id=order_id). \
-                exclude(status='basket').select_related('contact', ).prefetch_related(
-                'ordered_items__product_info', 'ordered_items__product_info__product',
-                'ordered_items__product_info__shop', 'ordered_items__product_info__product_parameters__parameter'
-            ).annotate(total_cost=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price_rrc'))) \
-                .distinct()
+            order = order.filter(id=order_id)
+        if stream_requested(request):
+            if fieldset['fields'] is None and fieldset['expand'] is None:
+                rows = iter_orders(order)
+            else:
+                rows = iter_serialized(order, OrderSerializer,
+                                       prefetch=related_prefetch(fieldset, 'ordered_items.product_info'), **fieldset)
+            return StreamingJSONResponse(iter_json_list(rows, prefix='{"Orders":[', suffix=']}'))
+        if fieldset['fields'] is None and fieldset['expand'] is None:
+            data = serialize_orders(order)
         else:
-            order = Order.objects.filter(user__id=request.user.id). \
-                exclude(status='basket').select_related('contact').prefetch_related(
-                'ordered_items__product_info', 'ordered_items__product_info__product',
-                'ordered_items__product_info__shop', 'ordered_items__product_info__product_parameters__parameter'
-            ).annotate(total_cost=Sum(F('ordered_items__quantity') * F('ordered_items__product_info__price_rrc'))) \
-                .distinct()
-        if order:
-            serializer = OrderSerializer(order, many=True)
-            return JsonResponse({'Orders': serializer.data})
+            data = OrderSerializer(order, many=True, **fieldset).data
+        if data:
+            return JsonResponse({'Orders': data})
         else:
             return Response('У вас нет оформленных Заказов')
 
@@ -547,17 +832,19 @@ class OrderView(APIView):
             order_id = request.data['order_id']
             print(order_id, contact_id)
             if order_id.isdigit() and contact_id.isdigit():
+                # товары резервируются вместе со сменой статуса, при нехватке заказ не оформляется
                 try:
-                    order = Order.objects.filter(user_id=request.user.id, id=order_id, status='basket').update(
-                            status='new', contact_id=contact_id)
+                    order = checkout_order(request.user.id, int(order_id), int(contact_id))
+                except OutOfStock as error:
+                    return JsonResponse({'Status': False,
+                                         'Errors': f'Недостаточно товаров на складе: '
+                                                   f'{", ".join(map(str, error.product_info_ids))}'})
                 except IntegrityError as error:
                     return JsonResponse({'Status': False, 'Messege': str(error)})
                 if order:
-                    if order:
-                        # Отправку сообщения в Email пришлось отключить из-за конфликта с почтой
-                        # new_order.send(sender=self.__class__, user_id=request.user.id)
-                        return JsonResponse({'Status': True})
-                    return JsonResponse({'Status': True, 'Messege': f'Заказ {order_id} оформлен'})
+                    # Отправку сообщения в Email пришлось отключить из-за конфликта с почтой
+                    # new_order.send(sender=self.__class__, user_id=request.user.id)
+                    return JsonResponse({'Status': True})
                 else:
                     return JsonResponse({'Status': False, 'Messege': f'Заказ {order_id} уже оформлен'})
             else:
@@ -566,5 +853,17 @@ class OrderView(APIView):
         else:
             return JsonResponse({'Status': False, 'Errors': 'Необходимо передать order_id и contact_id'})
 
+    def delete(self, request, *args, **kwargs):
+        """Отмена заказа покупателем (до сборки), зарезервированные товары возвращаются на склад"""
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Ошибка аутентификации'}, status=403)
+
+        order_id = str(request.data.get('order_id', ''))
+        if not order_id.isdigit():
+            return JsonResponse({'Status': False, 'Errors': 'Необходимо передать order_id цифрами'})
+        if cancel_order(request.user.id, int(order_id)):
+            return JsonResponse({'Status': True, 'Message': f'Заказ {order_id} отменён'})
+        return JsonResponse({'Status': False, 'Errors': f'Заказ {order_id} не найден или уже не может быть отменён'})
+
 
 
@@ -159,3 +159,14 @@ REST_FRAMEWORK = {
 
 }
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Кэш ответов каталога (backend/cache.py): запись свежая CATALOG_CACHE_FRESH сек.,
+# после этого отдаётся и обновляется в фоне, пока не истечёт CATALOG_CACHE_TIMEOUT
+CATALOG_CACHE_FRESH = 60
+CATALOG_CACHE_TIMEOUT = 60 * 60
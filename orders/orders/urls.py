@@ -17,12 +17,19 @@ from django.contrib import admin
 from django.urls import path
 
 from backend.views import ImportPrice, ShopView, ProductView, RegisterUser, LoginUser, RegisterPartner, Basket, \
-    PartnerOrder, OrderView, ContactView, CategoryView
+    PartnerOrder, OrderView, ContactView, CategoryView, AdminImport, \
+    ExportPrice, ProductFacets, ProductSearch, ProductAutocomplete, ProductBatch, \
+    ProductChanges
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/v1/shop', ShopView.as_view(), name='shops view'),
     path('api/v1/product', ProductView.as_view(), name='product view'),
+    path('api/v1/product/facets', ProductFacets.as_view(), name='product facets'),
+    path('api/v1/product/batch', ProductBatch.as_view(), name='product batch'),
+    path('api/v1/product/changes', ProductChanges.as_view(), name='product changes'),
+    path('api/v1/product/search', ProductSearch.as_view(), name='product search'),
+    path('api/v1/product/autocomplete', ProductAutocomplete.as_view(), name='product autocomplete'),
     path('api/v1/import', ImportPrice.as_view(), name='import price'),
     path('api/v1/shop', ShopView.as_view(), name='add new shop'),
     path('api/v1/product', ProductView.as_view(), name='add new product'),
@@ -32,6 +39,10 @@ urlpatterns = [
     path('api/v1/user/contact', ContactView.as_view(), name='contact_user'),
     path('api/v1/user/contact/<int:contact_id>', ContactView.as_view(), name='contact_user'),
     path('api/v1/partner/import', ImportPrice.as_view(), name='import price'),
+    path('api/v1/partner/import/<int:job_id>', ImportPrice.as_view(), name='import job status'),
+    path('api/v1/export', ExportPrice.as_view(), name='export price'),
+    path('api/v1/partner/export', ExportPrice.as_view(), name='export price partner'),
+    path('api/v1/admin/import', AdminImport.as_view(), name='admin import'),
     path('api/v1/partner/registration', RegisterPartner.as_view(), name='registration Partner'),
     path('api/v1/user/basket', Basket.as_view(), name='basker_user'),
     path('api/v1/partner/order', PartnerOrder.as_view(), name='order_partner'),